@@ -0,0 +1,82 @@
+"""
+Filtered parsing of a long report listing: eager parsing (every Report and URL built, then Reports.filter or a
+post-hoc selection throws most of them away) against the filter pushed down into Reports.parse_report_list.
+
+usage:
+    $ python benchmarks/bench_filter.py [--reports 2000] [--rounds 3]
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import make_report_list, START  # noqa: E402
+from lib.models import Reports, ReportFilter  # noqa: E402
+
+
+def best_of(rounds, fn):
+    timings = []
+    for _ in range(rounds):
+        ts = time.time()
+        fn()
+        timings.append(time.time() - ts)
+    return min(timings)
+
+
+def summary(reports):
+    return sorted((report_id, sorted(report.urls)) for report_id, report in reports.reports.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='eager parse then filter vs filter pushdown')
+    parser.add_argument('--reports', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    report_list = make_report_list(args.reports)
+    last = START + timedelta(hours=6 * (args.reports - 1))
+    week = (last - timedelta(days=7), last)
+
+    def eager_range(reports):
+        for report in reports.reports.values():
+            if not week[0].isoformat() <= report.timestamp[:-1] <= week[1].isoformat():
+                reports.delete(report)
+
+    def eager_types(reports):
+        for report in reports.reports.values():
+            for report_type in list(report.urls):
+                if report_type not in ('gateway', 'radio'):
+                    reports.unregister_url(report.urls.pop(report_type))
+
+    cases = [('rn [1]', lambda reports: reports.filter('rn', [1]), ReportFilter.from_filter('rn', [1])),
+             ('rrn [1..4]', lambda reports: reports.filter('rrn', [1, 2, 3, 4]),
+              ReportFilter.from_filter('rrn', [1, 2, 3, 4])),
+             ('last 7 days', eager_range, ReportFilter(start=week[0], end=week[1])),
+             ('gateway, radio', eager_types, ReportFilter(types=['gateway', 'radio']))]
+
+    print(" | {:^16s} | {:^8s} | {:^10s} | {:^10s} | {:^8s} |".format('filter', 'kept', 'eager [s]', 'pushed [s]',
+                                                                       'speedup'))
+    for label, eager_filter, report_filter in cases:
+        def eager():
+            reports = Reports()
+            reports.parse_report_list(report_list)
+            eager_filter(reports)
+            return reports
+
+        def pushed():
+            reports = Reports()
+            reports.parse_report_list(report_list, report_filter)
+            return reports
+
+        kept = summary(pushed())
+        assert kept == summary(eager()), "pushdown must select what eager filtering does"
+        eager_took, pushed_took = best_of(args.rounds, eager), best_of(args.rounds, pushed)
+        print(" | {:16s} | {:8d} | {:10.3f} | {:10.3f} | {:7.1f}x |".format(label, len(kept), eager_took, pushed_took,
+                                                                           eager_took / pushed_took))
+
+
+if __name__ == '__main__':
+    main()
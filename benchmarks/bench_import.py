@@ -0,0 +1,53 @@
+"""
+Import-time benchmark for the cli modules.
+
+Python 2.7 has no `-X importtime`, so every sample imports the module in a fresh interpreter and reports the wall
+time taken along with which of the heavy/optional dependencies ended up loaded as a side effect.
+
+usage:
+    $ python benchmarks/bench_import.py [-n RUNS] [module ...]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['yaml', 'requests', 'tqdm', 'logging.handlers', 'subprocess', 'multiprocessing', 'uuid', 'crontab']
+SNIPPET = """
+import json, sys, time
+ts = time.time()
+import {module}
+te = time.time()
+print(json.dumps({{'ms': (te - ts) * 1000, 'modules': len(sys.modules),
+                   'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def sample(module):
+    output = subprocess.check_output([sys.executable, '-c', SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+                                     cwd=ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure cold import time of the cli modules')
+    parser.add_argument('-n', '--runs', type=int, default=20)
+    parser.add_argument('modules', nargs='*', default=['lib.utils', 'lib.models', 'lib.s3'])
+    args = parser.parse_args()
+    print(" | {:^12s} | {:^10s} | {:^10s} | {:^8s} | {:40s} |".format('module', 'min [ms]', 'median [ms]', 'modules',
+                                                                      'heavy modules loaded'))
+    for module in args.modules:
+        samples = [sample(module) for _ in range(args.runs)]
+        timings = sorted(s['ms'] for s in samples)
+        print(" | {:12s} | {:10.2f} | {:11.2f} | {:8d} | {:40s} |".format(module,
+                                                                         timings[0],
+                                                                         timings[len(timings) // 2],
+                                                                         samples[-1]['modules'],
+                                                                         ','.join(samples[-1]['heavy'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Memory benchmark for the URL and IndexItem models.
+
+Builds N URL objects from synthetic pre-signed URLs and M IndexItems (as loaded from a history.index file) and
+reports the resident memory each population adds. Inputs (raw url strings, index lines) are generated before
+measuring so only the model objects are accounted for.
+
+usage:
+    $ python benchmarks/bench_memory.py [--urls 100000] [--index-items 1000000]
+"""
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import REPORT_TYPES, START, make_presigned_url  # noqa: E402
+from lib.models import URL, IndexItem  # noqa: E402
+from datetime import timedelta  # noqa: E402
+
+
+def rss():
+    """
+    Current resident set size in bytes
+    :return: int
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(label, prepare, build, count):
+    raw = prepare(count)
+    gc.collect()
+    before = rss()
+    ts = time.time()
+    population = build(raw)
+    te = time.time()
+    gc.collect()
+    used = rss() - before
+    print(" | {:12s} | {:>9d} | {:10.1f} | {:12.1f} | {:9.2f} |".format(label, count, used / 10.0 ** 6,
+                                                                        float(used) / count, te - ts))
+    return population
+
+
+def prepare_urls(count):
+    return [make_presigned_url(START + timedelta(hours=6 * (i // len(REPORT_TYPES))), REPORT_TYPES[i % len(REPORT_TYPES)])
+            for i in range(count)]
+
+
+def build_urls(raw):
+    return [URL('report-{}'.format(i // len(REPORT_TYPES)), unicode(REPORT_TYPES[i % len(REPORT_TYPES)]), url)
+            for i, url in enumerate(raw)]
+
+
+def prepare_index(count):
+    # lines exactly as they are persisted to history.index
+    return [json.dumps(json.dumps({
+        'date': (START + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"),
+        'hash': "/tmp/reports/2017/11/20/06/{}-{}.csv".format(REPORT_TYPES[i % len(REPORT_TYPES)], i).encode('base64')
+            .strip()})) for i in range(count)]
+
+
+def build_index(lines):
+    return [IndexItem(json.loads(line)) for line in lines]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure memory used by the URL and IndexItem models')
+    parser.add_argument('--urls', type=int, default=100000)
+    parser.add_argument('--index-items', type=int, default=1000000)
+    args = parser.parse_args()
+    print(" | {:^12s} | {:^9s} | {:^10s} | {:^12s} | {:^9s} |".format('model', 'objects', 'RSS [MB]', 'bytes/object',
+                                                                      'build [s]'))
+    urls = measure('URL', prepare_urls, build_urls, args.urls)
+    index = measure('IndexItem', prepare_index, build_index, args.index_items)
+    return urls, index
+
+
+if __name__ == '__main__':
+    main()
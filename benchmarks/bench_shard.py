@@ -0,0 +1,101 @@
+"""
+Sharded download of one report listing by several local instances (nodes) sharing a save directory and a membership
+lock directory, against the stand-in server. Every node is capped at --bandwidth to emulate the NIC of a host of
+its own. Checks that every object is downloaded exactly once across the nodes,
+that the merged history.index covers every object, and that a rerun without one of the nodes picks up its share
+without transferring anything again.
+
+usage:
+    $ python benchmarks/bench_shard.py [--nodes 3] [--reports 16] [--bandwidth 10M]
+"""
+from __future__ import print_function
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import standin_server  # noqa: E402
+from lib.models import Reports  # noqa: E402
+from lib.s3 import S3Downloader  # noqa: E402
+from lib.shard import HashRing, get_index_shard_paths, merge_indexes  # noqa: E402
+
+
+def run_node(node, directory, members, report_list, bandwidth):
+    config = {'directory': directory, 'retention_time': '1d', 'max_bandwidth': bandwidth,
+              'shard': {'node': node, 'directory': members, 'settle': 1.0}}
+    reports = Reports()
+    reports.parse_report_list(report_list)
+    S3Downloader(config).download_reports(reports)
+
+
+def run_cluster(nodes, directory, members, report_list, bandwidth):
+    ts = time.time()
+    processes = [Process(target=run_node, args=(node, directory, members, report_list, bandwidth)) for node in nodes]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    return time.time() - ts
+
+
+def count_lines(path):
+    with open(path) as f:
+        return sum(1 for line in f if line.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sharded download across local instances')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--reports', type=int, default=16)
+    parser.add_argument('--bandwidth', default='10M', help='download rate of each node in bytes/s')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    server, base = standin_server.start()
+    report_list = standin_server.make_report_list(base, args.reports)
+    objects = sum(len(report['report']) for report in report_list['history'])
+    root = tempfile.mkdtemp()
+    try:
+        directory, members = os.path.join(root, 'save'), os.path.join(root, 'members')
+        single = run_cluster(['single'], os.path.join(root, 'single'), os.path.join(root, 'single-members'),
+                             report_list, args.bandwidth)
+        del server.requests[:]
+
+        nodes = ['node-{}'.format(i) for i in range(args.nodes)]
+        elapsed = run_cluster(nodes, directory, members, report_list, args.bandwidth)
+        requests = len(server.requests)
+        shards = get_index_shard_paths(directory)
+        print("objects {}, 1 node {:0.2f}s, {} nodes {:0.2f}s, GETs {} (unique {})".format(
+            objects, single, args.nodes, elapsed, requests, len(set(server.requests))))
+        for path in shards:
+            print("  {:40s} {:5d} entries".format(os.path.basename(path), count_lines(path)))
+        merged = merge_indexes(shards, os.path.join(directory, 'history.index'))
+        print("merged history.index {} entries".format(merged))
+        assert requests == objects == merged, "objects must be downloaded and indexed exactly once"
+
+        # node-0 stops: the remaining nodes pick up its share, finding its files already in the shared directory
+        del server.requests[:]
+        sent = server.sent
+        elapsed = run_cluster(nodes[1:], directory, members, report_list, args.bandwidth)
+        merged = merge_indexes(get_index_shard_paths(directory), os.path.join(directory, 'history.index'))
+        print("without {}: {:0.2f}s, GETs {}, bytes sent {}, merged history.index {} entries".format(
+            nodes[0], elapsed, len(server.requests), server.sent - sent, merged))
+
+        keys = ["2017/11/{:02d}/{:02d}/{}.csv".format(day, hour, i) for day in range(1, 29) for hour in range(24)
+                for i in range(8)]
+        before, after = HashRing(nodes), HashRing(nodes[1:])
+        moved = sum(1 for key in keys if before.get_node(key) != after.get_node(key))
+        print("ring: removing 1 of {} nodes moves {:0.1%} of {} keys".format(args.nodes, float(moved) / len(keys),
+                                                                           len(keys)))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Per connection download throughput of the requests and socket transports against the stand-in server (run in a
+process of its own, so it doesn't compete with the client for the GIL). Every object is fetched over one kept alive
+connection and streamed the way download_file does: received into a reused buffer, md5'd and newline counted. Each
+transport is run with the kernel's auto-tuned receive buffer and with --receive-buffer as SO_RCVBUF. Loopback has
+next to no bandwidth-delay product, so this measures the client's per byte overhead rather than the receive window;
+on a long fat WAN link a larger SO_RCVBUF is what keeps a single connection from stalling on the window.
+
+usage:
+    $ python benchmarks/bench_transport.py [--size 64M] [--count 8] [--receive-buffer 4M] [--chunk-size 64K]
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import sys
+import time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import standin_server  # noqa: E402
+from lib.transport import create_transport  # noqa: E402
+from lib.utils import parse_size  # noqa: E402
+
+
+def serve(queue, size):
+    server, base = standin_server.start(size=size)
+    queue.put(base)
+    while True:
+        time.sleep(3600)
+
+
+def fetch(transport, url, chunk_size):
+    """
+    :return: bytes received
+    """
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    md5 = hashlib.md5()
+    newlines = received = 0
+    response = transport.get(url, stream=True, timeout=20)
+    try:
+        for read in iter(lambda: transport.readinto(response, view), 0):
+            md5.update(view[:read])
+            newlines += buf.count(b'\n', 0, read)
+            received += read
+    finally:
+        transport.close(response)
+    return received
+
+
+def run(name, receive_buffer, url, count, chunk_size):
+    transport = create_transport(name, pool_size=1, receive_buffer=receive_buffer)
+    fetch(transport, url, chunk_size)  # warms the server's body cache and opens the connection
+    cpu, ts = sum(os.times()[:2]), time.time()
+    received = sum(fetch(transport, url, chunk_size) for _ in range(count))
+    elapsed, cpu = time.time() - ts, sum(os.times()[:2]) - cpu
+    metrics = transport.get_metrics()
+    print("{:10s} SO_RCVBUF {:>8s}  {:8.1f} MB/s  {:6.2f} CPU s/GB  connections {}".format(
+        name, receive_buffer or 'auto', received / elapsed / 10 ** 6, cpu / (received / 10. ** 9),
+        metrics['connections']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per connection throughput of the download transports')
+    parser.add_argument('--size', default='64M', help='object size')
+    parser.add_argument('--count', type=int, default=8, help='objects fetched per run')
+    parser.add_argument('--receive-buffer', default='4M', help='SO_RCVBUF of the tuned runs')
+    parser.add_argument('--chunk-size', default='64K', help='bytes received per read')
+    args = parser.parse_args()
+
+    queue = Queue()
+    server = Process(target=serve, args=(queue, parse_size(args.size)))
+    server.daemon = True
+    server.start()
+    url = "{}/2017/11/20/00/station.csv".format(queue.get())
+    try:
+        for name in ('requests', 'socket'):
+            for receive_buffer in (None, args.receive_buffer):
+                run(name, receive_buffer, url, args.count, parse_size(args.chunk_size))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
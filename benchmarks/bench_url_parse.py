@@ -0,0 +1,89 @@
+"""
+Microbenchmark of pre-signed URL meta-data parsing: the original split/map/filter implementation of
+URL.generate_meta against URLParser, cold (empty cache) and warm (re-signed urls for already seen paths).
+
+usage:
+    $ python benchmarks/bench_url_parse.py [--reports 2000] [--rounds 3]
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+from urlparse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fixtures import make_report_list  # noqa: E402
+from lib.models import URLParser, NewObject  # noqa: E402
+
+
+def legacy_generate_meta(url, report_type):
+    """
+    URL.generate_meta as originally implemented
+    """
+    meta = NewObject()
+    parsed_url = urlparse(url)
+    map(lambda x:
+        setattr(meta, x.split(' ')[0], x.split(' ')[1])
+        if (len(x.split(' ')[1]) <= 4 or x.split(' ')[0] == 'tenant')
+        else setattr(meta, x.split(' ')[0], x.split(' ')[1][-2:]),
+        filter(lambda x: len(x.split(' ')) > 1, parsed_url.path.replace('%3D', ' ').split('/')))
+    setattr(meta, 'report_type', report_type)
+    setattr(meta, 'path', "{}/{}/{}/{}/{}".format(meta.year, meta.month, meta.day, meta.hour,
+                                                   parsed_url.path.split('/')[-1]))
+    return meta
+
+
+def best_of(rounds, fn):
+    timings = []
+    for _ in range(rounds):
+        ts = time.time()
+        fn()
+        timings.append(time.time() - ts)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare url meta-data parsing implementations')
+    parser.add_argument('--reports', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    report_list = make_report_list(args.reports)
+    urls = [(report_type, url) for report in report_list['history'] for report_type, url in report['report'].items()]
+
+    # both implementations must agree before comparing speed
+    url_parser = URLParser()
+    for report_type, url in urls:
+        legacy, meta = legacy_generate_meta(url, report_type), url_parser.parse_meta(url, report_type)
+        assert (legacy.tenant, legacy.path) == (meta.tenant, meta.path), (legacy.path, meta.path)
+
+    def legacy():
+        for report_type, url in urls:
+            legacy_generate_meta(url, report_type)
+
+    def cold():
+        cold_parser = URLParser()
+        for report_type, url in urls:
+            cold_parser.parse(url, report_type)
+
+    resigned = [(report_type, url.replace('X-Amz-Expires=900', 'X-Amz-Expires=899')) for report_type, url in urls]
+
+    def warm():
+        for report_type, url in resigned:
+            url_parser.parse(url, report_type)
+
+    def batch():
+        URLParser().parse_report_list(report_list)
+
+    print(" | {:^22s} | {:^8s} | {:^10s} | {:^8s} |".format('implementation', 'urls', 'us/url', 'speedup'))
+    baseline = best_of(args.rounds, legacy)
+    for label, fn in [('legacy generate_meta', legacy), ('URLParser (cold)', cold), ('URLParser (re-sign)', warm),
+                      ('parse_report_list', batch)]:
+        took = baseline if fn is legacy else best_of(args.rounds, fn)
+        print(" | {:22s} | {:8d} | {:10.2f} | {:7.1f}x |".format(label, len(urls), took / len(urls) * 10 ** 6,
+                                                                 baseline / took))
+
+
+if __name__ == '__main__':
+    main()
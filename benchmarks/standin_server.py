@@ -0,0 +1,133 @@
+"""
+Local stand-in for the S3 report bucket, serving a deterministic CSV body for any report path with the ETag, Range,
+If-Range and If-None-Match behaviour of S3, so downloads can be exercised and timed without network access.
+
+usage:
+    from benchmarks import standin_server
+
+    server, base = standin_server.start()
+    report_list = standin_server.make_report_list(base, 4)
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import threading
+import time
+import urlparse
+
+from benchmarks.fixtures import make_report_list as make_fixture_report_list
+
+S3_BASE = 'https://reports.s3.ap-southeast-2.amazonaws.com'
+# body size per report type, other types are DEFAULT_SIZE bytes
+SIZES = {'station': 3000000}
+DEFAULT_SIZE = 200000
+
+
+def body_for(path, size=None):
+    """
+    :param path: url path, the body is derived from it
+    :param size: bytes, defaults to the size of the report type
+    :return: str CSV body
+    """
+    if size is None:
+        size = SIZES.get(path.rsplit('/', 1)[-1].split('.')[0], DEFAULT_SIZE)
+    line = "tenant,{},value\n".format(hashlib.md5(path).hexdigest())
+    return ("header,a,b\n" + line * (size // len(line) + 1))[:size]
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_empty(self, status, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', '"{}"'.format(etag))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        path = urlparse.urlparse(self.path).path
+        with server.lock:
+            server.requests.append(path)
+        if path in server.failing:
+            return self.send_empty(503)
+        data, etag = server.get_body(path)
+        if self.headers.get('If-None-Match', '').strip('"') == etag:
+            return self.send_empty(304, etag)
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range', '"{}"'.format(etag)).strip('"') == etag:
+            start, _, end = byte_range.split('=')[1].partition('-')
+            start, end = int(start), int(end) if end else len(data) - 1
+            if start >= len(data):
+                return self.send_empty(416)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"{}"'.format(etag))
+        self.end_headers()
+        for position in range(0, len(body), 65536):
+            self.wfile.write(body[position:position + 65536])
+            with server.lock:
+                server.sent += len(body[position:position + 65536])
+            if server.delay:
+                time.sleep(server.delay)
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # concurrent workers connect in bursts, the default backlog of 5 stalls them on SYN retries
+    request_queue_size = 256
+
+    def __init__(self, address, delay=0, size=None):
+        """
+        :param address: (host, port)
+        :param delay: seconds slept after every 64KB sent, to emulate a slow link
+        :param size: bytes of every body, defaults to the size of the report type
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+        self.delay = delay
+        self.size = size
+        self.bodies = {}  # path -> (body, etag), built once
+        self.lock = threading.Lock()
+        self.requests = []  # paths of every GET, in arrival order
+        self.sent = 0
+        self.failing = set()  # paths answered with a 503
+
+    def get_body(self, path):
+        with self.lock:
+            if path not in self.bodies:
+                data = body_for(path, self.size)
+                self.bodies[path] = (data, hashlib.md5(data).hexdigest())
+            return self.bodies[path]
+
+
+def start(port=0, delay=0, size=None):
+    """
+    Serve on a daemon thread
+    :return: tuple (StandinServer, base url)
+    """
+    server = StandinServer(('127.0.0.1', port), delay, size)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def make_report_list(base, num_reports, **kwargs):
+    """
+    Report list response whose pre-signed urls point at the stand-in server, see fixtures.make_report_list
+    """
+    report_list = make_fixture_report_list(num_reports, **kwargs)
+    for report in report_list['history']:
+        for report_type, url in report['report'].items():
+            report['report'][report_type] = unicode(url.replace(S3_BASE, base))
+    return report_list
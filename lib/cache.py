@@ -0,0 +1,113 @@
+from utils import destination_exists, make_sure_directory_exists, parse_interval
+from collections import OrderedDict
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger('MetadataCache')
+
+
+class MetadataCache(object):
+    """
+    Persistent cache of object sizes and ETags. Published report objects never change, so entries are keyed by the
+    stable <tenant>/<year>/<month>/<day>/<hour>/<type>.csv path of a url rather than its rotating pre-signed form.
+    Entries expire after a TTL and the least recently used are evicted beyond max_entries.
+    Stored as a JSON list of [key, size, etag, stored epoch], least recently used first.
+    """
+
+    def __init__(self, path, ttl='30d', max_entries=100000):
+        """
+        :param path: cache file
+        :param ttl: interval (i.e 12h, 30d) after which an entry is probed again, None to never expire
+        :param max_entries:
+        """
+        self.path = path
+        self.ttl = parse_interval(ttl) if ttl else None
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(url):
+        return "{}/{}".format(url.meta.tenant, url.meta.path)
+
+    def load(self):
+        if not destination_exists(self.path):
+            return self
+        try:
+            with open(self.path) as f:
+                rows = json.load(f)
+        except ValueError as e:
+            logger.warn("METADATA_CACHE:CORRUPT:{}:DISCARDING:MESSAGE:{}".format(self.path, e))
+            return self
+        oldest = time.time() - self.ttl if self.ttl else 0
+        for key, size, etag, stored in rows[-self.max_entries:]:
+            if stored >= oldest:
+                self.entries[key] = (size, etag, stored)
+        self.dirty = len(self.entries) != len(rows)
+        logger.debug("METADATA_CACHE:LOADED:{}".format(len(self.entries)))
+        return self
+
+    def save(self):
+        """
+        Write the cache when it changed, atomically so a concurrent reader never sees a partial file
+        """
+        if not self.dirty:
+            return
+        make_sure_directory_exists(self.path)
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump([[key, size, etag, stored] for key, (size, etag, stored) in self.entries.items()], f)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def get(self, url):
+        """
+        :param url: URL
+        :return: tuple (size, etag) or None
+        """
+        key = self.get_key(url)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        if self.ttl and entry[2] < time.time() - self.ttl:
+            self.dirty = True
+            self.misses += 1
+            return None
+        # most recently used last
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[:2]
+
+    def put(self, url):
+        """
+        Record the size and ETag of a url
+        :param url: URL
+        """
+        if url.get_size() is None:
+            return
+        key = self.get_key(url)
+        self.entries.pop(key, None)
+        self.entries[key] = (url.get_size(), url.get_etag(), int(time.time()))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def fill(self, url):
+        """
+        Set the size and ETag of a url from the cache
+        :param url: URL
+        :return: True on a hit
+        """
+        entry = self.get(url)
+        if entry is None:
+            return False
+        size, etag = entry
+        url.set_size(size)
+        if etag:
+            url.set_etag(etag)
+        return True
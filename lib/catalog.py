@@ -0,0 +1,119 @@
+from models import Reports, Report, URL, URLMeta, intern_string
+from datetime import datetime
+import os
+import logging
+
+logger = logging.getLogger('Catalog')
+
+
+class Catalog(object):
+    """
+    Offline view of the reports already downloaded, answered from history.index alone without any network access.
+    Each entry carries the size, ETag, md5, row count and header recorded when the file was downloaded (entries
+    indexed before these were recorded only have what was known at the time).
+    """
+
+    def __init__(self, reports):
+        """
+        :param reports: Reports holding the loaded index
+        """
+        self.reports = reports
+
+    def get_period(self, item):
+        """
+        Report period of an entry, from its destination <save_path>/<year>/<month>/<day>/<hour>/<type>.csv
+        :param item: IndexItem
+        :return: datetime or None for destinations outside of that layout
+        """
+        parts = item.get_destination().split('/')
+        try:
+            return datetime(*[int(part) for part in parts[-5:-1]])
+        except (ValueError, TypeError):
+            return None
+
+    def entries(self, types=None, start=None, end=None, exclude_types=None):
+        """
+        Retained (not pruned or evicted) entries, optionally limited to report types and a period range
+        :param types: list of report types, None for all
+        :param start: datetime, include periods at or after
+        :param end: datetime, include periods before
+        :param exclude_types: list of report types left out
+        :return: list of (datetime period, IndexItem) sorted by period
+        """
+        entries = []
+        for item in self.reports.get_retained_items():
+            if (types and item.get_type() not in types) or (exclude_types and item.get_type() in exclude_types):
+                continue
+            period = self.get_period(item)
+            if period is None or (start and period < start) or (end and period >= end):
+                continue
+            entries.append((period, item))
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def summary(self, entries):
+        """
+        Totals per report type
+        :param entries: see entries()
+        :return: dict {report_type: {'files': n, 'size': bytes, 'rows': n, 'first': datetime, 'last': datetime}}
+        """
+        totals = {}
+        for period, item in entries:
+            total = totals.setdefault(item.get_type(), {'files': 0, 'size': 0, 'rows': 0, 'first': period,
+                                                        'last': period})
+            total['files'] += 1
+            total['size'] += item.get_size() or 0
+            total['rows'] += item.get_rows() or 0
+            total['last'] = period
+        return totals
+
+    def to_reports(self, entries):
+        """
+        Group entries into Report objects so they render with Reports.display_reports/display_summary, urls are
+        file:// urls of the local copies
+        :param entries: see entries()
+        :return: Reports
+        """
+        reports = Reports(self.reports.save_path, self.reports.index_path, self.reports.retention_time)
+        grouped = {}
+        for period, item in entries:
+            report = grouped.get(period)
+            if report is None:
+                report = grouped[period] = Report(period.strftime("%Y-%m-%d %H:%M:%S"), {})
+            url = URL(report.get_id(), item.get_type(), "file://{}".format(item.get_destination()))
+            url.meta = URLMeta(year=intern_string("{:04d}".format(period.year)),
+                               month=intern_string("{:02d}".format(period.month)),
+                               day=intern_string("{:02d}".format(period.day)),
+                               hour=intern_string("{:02d}".format(period.hour)),
+                               report_type=item.get_type(),
+                               filename=os.path.basename(item.get_destination()),
+                               path="/".join(item.get_destination().split('/')[-5:]))
+            url.set_size(item.get_size())
+            url.set_etag(item.get_etag())
+            url.set_downloaded(True)
+            report.update_urls(url)
+        for report in grouped.values():
+            reports.add(report)
+        reports.set_downloaded(True)
+        return reports
+
+    def display(self, types=None, start=None, end=None, detailed=False, exclude_types=None):
+        """
+        Print the local reports, with sizes and per type totals when detailed
+        :return: Reports
+        """
+        entries = self.entries(types, start, end, exclude_types)
+        reports = self.to_reports(entries)
+        reports.display_reports(detailed)
+        reports.display_summary(detailed)
+        if detailed:
+            print(" {:15s} | {:>7s} | {:>10s} | {:>12s} | {:19s} | {:19s}".format('report type', 'files', 'size [MB]',
+                                                                                  'rows', 'first', 'last'))
+            for report_type, total in sorted(self.summary(entries).items()):
+                print(" {:15s} | {:7d} | {:10d} | {:12d} | {:19s} | {:19s}".format(report_type,
+                                                                                  total['files'],
+                                                                                  total['size'] / 10 ** 6,
+                                                                                  total['rows'],
+                                                                                  str(total['first']),
+                                                                                  str(total['last'])))
+        return reports
@@ -157,3 +157,57 @@ class StartTimeNotAvailable(Exception):
 
     def __repr__(self):
         return self.message
+
+
+class UnknownTransform(Exception):
+    """Transform name not registered or provided by an entry point"""
+
+    def __init__(self, name):
+        self.message = "unknown transform: {}, check the transforms section of your config.yml".format(name)
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return self.message
+
+
+class TransformError(Exception):
+    """A transform rejected the object being downloaded"""
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return self.message
+
+
+class SharedSaveDirectory(Exception):
+    """Two tenants configured with the same save directory"""
+
+    def __init__(self, directory, tenants):
+        self.message = "tenants {} share the save directory {}, each tenant needs its own".format(
+            ', '.join(tenants), directory)
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return self.message
+
+
+class TenantTransportConflict(Exception):
+    """Tenants configured with different transport settings"""
+
+    def __init__(self, tenants):
+        self.message = "tenants {} configure different transport settings (transport, proxy, receive_buffer, " \
+                       "tcp_nodelay, dns_cache_ttl), all tenants share one transport".format(', '.join(tenants))
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return self.message
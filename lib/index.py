@@ -0,0 +1,221 @@
+from utils import make_sure_directory_exists, destination_exists
+from bisect import bisect_left, insort
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger('Index')
+
+
+class IndexWriter(object):
+    """
+    Single writer for the history.index file. Completion records are buffered by the coordinating process and
+    appended in batches through one open handle. A batch is durable once flush() returns, with an fsync of the file
+    when enabled, so the batch boundary is explicit rather than one open/dump/close per downloaded file.
+    """
+
+    def __init__(self, index_path, flush_interval=1.0, batch_size=100, fsync=False):
+        """
+        :param index_path: path of history.index
+        :param flush_interval: max seconds a record may stay buffered before being written
+        :param batch_size: number of buffered records that triggers a write regardless of the interval
+        :param fsync: fsync the index after every batch
+        """
+        self.index_path = index_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.buffer = []
+        self.handle = None
+        self.last_flush = time.time()
+        self.written = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        if self.handle is None:
+            if not make_sure_directory_exists(self.index_path):
+                logger.exception("INDEX_WRITER:CANNOT_MAKE_DIRECTORY")
+                raise Exception("CANNOT_APPEND_INDEX")
+            # unbuffered, each batch is appended with a single write and can't interleave with the batches of a run
+            # attached to the same directory
+            self.handle = open(self.index_path, 'a', 0)
+            self.last_flush = time.time()
+        return self
+
+    def append(self, index_item):
+        """
+        Buffer an IndexItem, writing the batch out when it is full or the flush interval has passed
+        :param index_item: IndexItem
+        :return: IndexItem
+        """
+        self.buffer.append(index_item)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        else:
+            self.poll()
+        return index_item
+
+    def poll(self):
+        """
+        Flush buffered records if the flush interval has passed, to be called periodically by the coordinator
+        :return:
+        """
+        if self.buffer and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def time_to_flush(self):
+        """
+        :return: seconds until the buffered records are due to be written, None when nothing is buffered
+        """
+        if not self.buffer:
+            return None
+        return max(self.last_flush + self.flush_interval - time.time(), 0)
+
+    def flush(self):
+        """
+        Write all buffered records as one batch
+        :return: number of records written
+        """
+        self.last_flush = time.time()
+        if not self.buffer:
+            return 0
+        self.open()
+        batch, self.buffer = self.buffer, []
+        try:
+            self.handle.write(''.join(json.dumps(item.dumps()) + '\n' for item in batch))
+            self.handle.flush()
+            if self.fsync:
+                os.fsync(self.handle.fileno())
+        except Exception as e:
+            logger.exception("INDEX_WRITER:FLUSH_FAILURE:MESSAGE:{}".format(e))
+            raise Exception("CANNOT_APPEND_INDEX")
+        self.written += len(batch)
+        logger.debug("INDEX_WRITER:FLUSHED:{}".format(len(batch)))
+        return len(batch)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+
+class TimeIndex(object):
+    """
+    In-memory view of history.index ordered by download time. The index file is an append-only log and therefore
+    already time ordered, so loading is a plain append; entries are also looked up by destination.
+    Finding expired entries is a bisect on the epochs rather than a scan of the whole history.
+    """
+
+    def __init__(self, items=None):
+        self.items = []
+        self.epochs = []
+        self.destinations = {}
+        self.contents = {}  # ETag or content md5 -> IndexItem
+        for item in items or []:
+            self.append(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, position):
+        return self.items[position]
+
+    def __repr__(self):
+        return "TimeIndex(items={})".format(len(self.items))
+
+    def append(self, item):
+        """
+        Add an IndexItem, entries without a date sort first (they are always considered stale)
+        :param item: IndexItem
+        :return: IndexItem
+        """
+        if item.get_evicted():
+            # tombstone, the file was removed to fit the disk quota but stays indexed so it isn't downloaded again
+            existing = self.destinations.get(item.get_destination())
+            if existing is not None:
+                existing.evicted = True
+            return existing
+        epoch = item.get_epoch() or 0
+        if not self.epochs or epoch >= self.epochs[-1]:
+            self.epochs.append(epoch)
+            self.items.append(item)
+        else:
+            # only possible when the clock went backwards between appends
+            position = bisect_left(self.epochs, epoch)
+            self.epochs.insert(position, epoch)
+            self.items.insert(position, item)
+        self.destinations[item.get_destination()] = item
+        for key in (item.get_etag(), item.get_digest()):
+            if key:
+                self.contents[key] = item
+        return item
+
+    def get(self, destination):
+        return self.destinations.get(destination)
+
+    def find_content(self, *keys):
+        """
+        Find a stored (not evicted and still on disk) item with identical content
+        :param keys: ETags and/or content md5 digests
+        :return: IndexItem or None
+        """
+        for key in keys:
+            item = self.contents.get(key) if key else None
+            if item is not None and not item.get_evicted() and destination_exists(item.get_destination()):
+                return item
+        return None
+
+    def expired(self, cutoff, since=None):
+        """
+        Entries downloaded before cutoff (and at or after since)
+        :param cutoff: epoch
+        :param since: epoch, entries before this were handled by an earlier prune
+        :return: list of IndexItem
+        """
+        start = bisect_left(self.epochs, since) if since else 0
+        return self.items[start:bisect_left(self.epochs, cutoff)]
+
+    def live(self, since=None):
+        """
+        Entries downloaded at or after since that have not been evicted, oldest first
+        :param since: epoch, typically the prune watermark
+        :return: generator of IndexItem
+        """
+        start = bisect_left(self.epochs, since) if since else 0
+        return (item for item in self.items[start:] if not item.get_evicted())
+
+
+def read_watermark(path):
+    """
+    Read the epoch up to which the index has already been pruned
+    :param path:
+    :return: int
+    """
+    if not destination_exists(path):
+        return 0
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().strip() or 0)
+    except (IOError, ValueError) as e:
+        logger.warn("WATERMARK:UNREADABLE:{}:MESSAGE:{}".format(path, e))
+        return 0
+
+
+def write_watermark(path, epoch):
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        f.write("{:d}".format(epoch))
+    os.rename(tmp_path, path)
@@ -0,0 +1,175 @@
+from utils import destination_exists, make_sure_directory_exists, get_part_path, file_md5
+import json
+import os
+import logging
+
+logger = logging.getLogger('Journal')
+
+QUEUED = 'queued'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+CLAIMED = 'claimed'
+DROPPED = 'dropped'
+
+
+class DownloadJournal(object):
+    """
+    Append-only on-disk log of the batch being downloaded, so an interrupted run (SIGINT, SIGTERM from a service
+    restart, a crash) resumes where it stopped instead of replanning the whole window:
+    {"op": "queued", "key": "2017/11/26/06/station.csv", "type": "station", "size": 1234, "etag": "..."}
+    {"op": "done", "key": "2017/11/26/06/station.csv", "size": 1234, "etag": "...", "md5": "...", "rows": 10, ...}
+    {"op": "failed", "key": "2017/11/26/06/station.csv"}
+    {"op": "claimed", "key": "2017/11/26/06/station.csv"}  (left to another run attached to the directory)
+    {"op": "dropped", "key": "2017/11/26/06/station.csv"}  (unfinished and no longer listed, its .part removed)
+    Keys are destinations relative to the save directory, stable across re-signed urls. The byte offset of an object
+    in progress is the size of its <destination>.part file. The journal is removed once every queued object is
+    done or failed.
+    """
+
+    def __init__(self, path, save_path, fsync=False):
+        """
+        :param path: journal file
+        :param save_path: save directory the keys are relative to
+        :param fsync: fsync every record, the queued batch is always fsync'd
+        """
+        self.path = path
+        self.save_path = save_path
+        self.fsync = fsync
+        self.records = {}  # key -> last record
+        self.handle = None
+        # the journal file was replayed or written by this run, only then is it this run's to remove
+        self.owned = False
+        # a run attached to another one leaves the journal to the run holding the lock
+        self.enabled = True
+
+    def get_destination(self, key):
+        return "{}/{}".format(self.save_path, key)
+
+    def replay(self):
+        """
+        Load the state of the previous run
+        :return: self
+        """
+        self.records = {}
+        self.owned = False
+        if not self.enabled or not destination_exists(self.path):
+            return self
+        self.owned = True
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn final write of a crashed run
+                    logger.warn("JOURNAL:SKIPPING_PARTIAL_RECORD:{}".format(self.path))
+                    continue
+                self.records[record['key']] = record
+        logger.info("JOURNAL:REPLAYED:{}:UNFINISHED:{}".format(len(self.records), len(self.get_unfinished())))
+        return self
+
+    def get_state(self, key):
+        """
+        :param key:
+        :return: QUEUED, IN_PROGRESS (a .part file exists), DONE, FAILED or None when not journaled
+        """
+        record = self.records.get(key)
+        if record is None:
+            return None
+        if record['op'] == QUEUED and destination_exists(get_part_path(self.get_destination(key))):
+            return IN_PROGRESS
+        return record['op']
+
+    def get_unfinished(self):
+        """
+        Objects queued by an earlier run and not yet completed, to be requested again with fresh pre-signed urls
+        :return: dict {key: bytes already downloaded}
+        """
+        unfinished = {}
+        for key, record in self.records.items():
+            if record['op'] == QUEUED:
+                part = get_part_path(self.get_destination(key))
+                unfinished[key] = os.path.getsize(part) if destination_exists(part) else 0
+        return unfinished
+
+    def get_completed(self):
+        """
+        Objects the previous run completed whose files are intact, verified against the recorded md5
+        :return: list of done records
+        """
+        completed = []
+        for key, record in self.records.items():
+            if record['op'] != DONE:
+                continue
+            destination = self.get_destination(key)
+            if destination_exists(destination) and (not record.get('md5') or file_md5(destination) == record['md5']):
+                completed.append(record)
+            else:
+                logger.warn("JOURNAL:DONE_BUT_MISSING_OR_MODIFIED:{}".format(destination))
+        return completed
+
+    def open(self):
+        if self.handle is None:
+            make_sure_directory_exists(self.path)
+            self.handle = open(self.path, 'a')
+        return self
+
+    def write(self, records, fsync=False):
+        if not self.enabled:
+            return
+        self.open()
+        self.owned = True
+        self.handle.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.handle.flush()
+        if fsync or self.fsync:
+            os.fsync(self.handle.fileno())
+        for record in records:
+            self.records[record['key']] = record
+
+    def queue(self, urls):
+        """
+        Record the batch about to be downloaded, durably before any transfer starts
+        :param urls: list of URL
+        """
+        self.write([{'op': QUEUED, 'key': url.meta.path, 'type': url.get_type(), 'size': url.get_size(),
+                     'etag': url.get_etag()} for url in urls], fsync=True)
+
+    def done(self, url, index_item):
+        """
+        :param url: URL
+        :param index_item: IndexItem recorded for it
+        """
+        self.write([{'op': DONE, 'key': url.meta.path, 'type': url.get_type(), 'size': index_item.get_size(),
+                     'etag': index_item.get_etag(), 'md5': index_item.get_digest(), 'rows': index_item.get_rows(),
+                     'header': index_item.get_header(), 'linked': index_item.get_linked(),
+                     'derived': index_item.get_derived()}])
+
+    def failed(self, url):
+        self.write([{'op': FAILED, 'key': url.meta.path}])
+
+    def claimed(self, url):
+        self.write([{'op': CLAIMED, 'key': url.meta.path}])
+
+    def dropped(self, keys):
+        """
+        Give up on unfinished objects that are no longer listed (out of the listed window, or now another node's
+        share), removing their .part files
+        :param keys: list of keys
+        """
+        self.write([{'op': DROPPED, 'key': key} for key in keys])
+        for key in keys:
+            part = get_part_path(self.get_destination(key))
+            if destination_exists(part):
+                os.remove(part)
+
+    def close(self):
+        """
+        Close the journal, removing it when nothing is left to resume and it is this run's
+        """
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        if self.enabled and self.owned and destination_exists(self.path) and not self.get_unfinished():
+            os.remove(self.path)
+            self.records = {}
+        self.owned = False
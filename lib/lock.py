@@ -0,0 +1,123 @@
+from utils import make_sure_directory_exists
+import os
+import time
+import errno
+import logging
+
+logger = logging.getLogger('Lock')
+
+
+def try_flock(handle, exclusive=True):
+    """
+    :param handle: open file
+    :param exclusive: exclusive or shared lock
+    :return: True when locked, False when another process holds a conflicting lock
+    """
+    import fcntl
+
+    try:
+        fcntl.flock(handle, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+
+
+class RunLock(object):
+    """
+    flock held on a save directory for the duration of a download run, so overlapping runs (a cron run and the
+    service, a manual download during a scheduled one) don't plan the same objects from the same history.index.
+    When another run holds it, a run either waits for it to finish, skips this run, or attaches to it: both
+    download, splitting the objects through per object claims (see ObjectClaim).
+    The lock is released by the kernel if the holder dies.
+    """
+    WAIT = 'wait'
+    SKIP = 'skip'
+    ATTACH = 'attach'
+    modes = (WAIT, SKIP, ATTACH)
+
+    def __init__(self, path, mode=WAIT, timeout=None, poll_interval=0.5):
+        """
+        :param path: lock file
+        :param mode: wait, skip or attach
+        :param timeout: seconds to wait for the lock before skipping the run, None to wait indefinitely
+        :param poll_interval: seconds between attempts while waiting
+        """
+        if mode not in self.modes:
+            raise Exception("INVALID_RUN_LOCK_MODE: {}, must be one of {}".format(mode, ', '.join(self.modes)))
+        self.path = path
+        self.mode = mode
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.handle = None
+        self.held = False
+        self.contended = False
+
+    def acquire(self):
+        """
+        :return: True when this run holds the lock, False when another run does (skipped, timed out or attached)
+        """
+        if self.held:
+            return True
+        self.handle = open(self.path, 'a')
+        self.held = try_flock(self.handle)
+        self.contended = not self.held
+        if self.held or self.mode != self.WAIT:
+            logger.info("RUN_LOCK:{}:{}".format('ACQUIRED' if self.held else 'HELD_ELSEWHERE:' + self.mode.upper(),
+                                                self.path))
+            return self.held
+        logger.warn("RUN_LOCK:HELD_ELSEWHERE:WAITING:{}".format(self.path))
+        ts = time.time()
+        while not self.held:
+            if self.timeout is not None and time.time() - ts >= self.timeout:
+                logger.warn("RUN_LOCK:WAIT_TIMED_OUT:{}:AFTER:{}".format(self.path, self.timeout))
+                return False
+            time.sleep(self.poll_interval)
+            self.held = try_flock(self.handle)
+        logger.info("RUN_LOCK:ACQUIRED:{}:WAITED:{:0.2f}".format(self.path, time.time() - ts))
+        return True
+
+    def is_attached(self):
+        return self.contended and not self.held and self.mode == self.ATTACH
+
+    def release(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        self.held = False
+        self.contended = False
+
+
+class ObjectClaim(object):
+    """
+    Claim on one object by the process downloading it, an flock on <destination>.claim. Runs attached to the same
+    save directory claim every object before requesting it and leave the objects claimed by others to them. A claim
+    left by a process that died is not held and is simply taken over.
+    """
+
+    def __init__(self, destination):
+        self.path = "{}.claim".format(destination)
+        self.handle = None
+
+    def acquire(self):
+        """
+        :return: True when claimed, False when another process holds the claim
+        """
+        make_sure_directory_exists(self.path)
+        self.handle = open(self.path, 'a')
+        if try_flock(self.handle):
+            return True
+        self.handle.close()
+        self.handle = None
+        return False
+
+    def release(self):
+        if self.handle is None:
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.handle.close()
+        self.handle = None
@@ -0,0 +1,249 @@
+from utils import parse_size
+from collections import deque
+from heapq import heappush, heappop
+from Queue import Empty
+import utils
+import time
+import logging
+
+logger = logging.getLogger('DownloadPool')
+
+
+class TokenBucket(object):
+    """
+    Bandwidth limit shared between worker processes. Workers take tokens (bytes) per chunk read, a worker that
+    overdraws the bucket sleeps until the refill at rate bytes/s has covered its debt, so the combined throughput of
+    every worker converges on rate with bursts of at most burst bytes.
+    Must be created before the worker processes are started.
+    """
+
+    def __init__(self, rate, burst=None, parent=None):
+        """
+        :param rate: bytes per second (or 50M style size)
+        :param burst: bytes that may be taken at once after idling, defaults to one second worth of rate
+        :param parent: TokenBucket the bytes are also taken from, i.e a tenant's bucket within the pool's
+        """
+        from multiprocessing import Value, Lock
+
+        self.rate = parse_size(rate)
+        self.burst = parse_size(burst) or self.rate
+        self.parent = parent
+        self.lock = Lock()
+        self.tokens = Value('d', self.burst, lock=False)
+        self.stamp = Value('d', time.time(), lock=False)
+
+    def consume(self, size):
+        """
+        Take size bytes worth of tokens, blocking while the bucket is in debt
+        :param size: bytes
+        """
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value + (now - self.stamp.value) * self.rate) - size
+            self.tokens.value = tokens
+            self.stamp.value = now
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+        if self.parent is not None:
+            self.parent.consume(size)
+
+
+class DownloadPool(object):
+    """
+    One set of download worker processes shared by any number of S3Downloader instances (tenants), each keeping its
+    own index, journal, retries and save directory. Tasks are handed to the workers one at a time, taking turns
+    between tenants, so a tenant with a large backlog can't starve the others, and every byte transferred draws on
+    one optional bandwidth budget, as well as on the downloader's own max_bandwidth when it has one.
+    """
+
+    def __init__(self, workers=10, chunk_size=8096, timeout=20, max_bandwidth=None, burst=None,
+                 worker_check_interval=1.0):
+        """
+        :param workers: number of worker processes
+        :param chunk_size: bytes read per chunk
+        :param timeout: per request connect/read timeout in seconds
+        :param max_bandwidth: combined download rate of all workers in bytes/s (or 50M style size), None for no limit
+        :param burst: see TokenBucket
+        :param worker_check_interval: seconds between checks that no worker has died while waiting on completions
+        """
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.max_bandwidth = max_bandwidth
+        self.burst = burst
+        self.worker_check_interval = worker_check_interval
+
+    def download(self, downloaders):
+        """
+        Plan a batch for every downloader, download them all on the shared workers and close the batches
+        :param downloaders: list of S3Downloader
+        :return: list of S3Downloader.get_batch_result() in the order of downloaders
+        """
+        sigterm = utils.sigterm_as_interrupt().install()
+        batches = []
+        try:
+            for downloader in downloaders:
+                batches.append((downloader, downloader.open_batch()))
+            self.run([(downloader, urls) for downloader, urls in batches if urls])
+            return [downloader.get_batch_result(urls) for downloader, urls in batches]
+        finally:
+            sigterm.restore()
+            for downloader, urls in batches:
+                downloader.close_batch()
+
+    def run(self, batches):
+        """
+        Download batches on the shared workers, every result is handed back to the downloader it belongs to
+        :param batches: list of (S3Downloader, list of URL)
+        """
+        # workers are forked with this table and only ever exchange task ids and TaskResult records with
+        # the coordinator, never the URL objects themselves
+        tasks = {}
+        ready = []  # per downloader queue of task ids, served in turns
+        home = {}  # task id -> its downloader's queue
+        for downloader, urls in batches:
+            queue = deque()
+            for url in urls:
+                task_id = len(tasks)
+                tasks[task_id] = (downloader, url)
+                home[task_id] = queue
+                queue.append(task_id)
+            ready.append(queue)
+        num_tasks = len(tasks)
+        if not num_tasks:
+            return
+        from multiprocessing import Queue, Process, freeze_support, Lock
+
+        utils.install_progress_logging()
+        logger.info("DOWNLOAD_POOL:NUM_TASKS:{}:TENANTS:{}".format(num_tasks, len(batches)))
+        freeze_support()
+        throttle = TokenBucket(self.max_bandwidth, self.burst) if self.max_bandwidth else None
+        write_lock = Lock()
+        out_queue = Queue()
+
+        utils.progress_write("|   DOWNLOADING {} FILES".format(num_tasks))
+
+        # task id handed to each worker (-1 when idle), cleared only once its result has been received so the work of a
+        # worker that dies, before taking the task or before its result is flushed, is not lost
+        assigned = [-1] * min(self.workers, num_tasks)
+        # every worker is handed tasks on its own queue, so the coordinator knows which worker holds which task
+        inboxes = [Queue() for _ in assigned]
+        # resolved in the coordinator (transforms and transports are built on first use), so the workers inherit
+        # them and share the transports' counters and the throttles
+        resources = dict((downloader, (downloader.budget, downloader.transforms, downloader.transport,
+                                       TokenBucket(downloader.max_bandwidth, parent=throttle)
+                                       if downloader.max_bandwidth else throttle))
+                         for downloader, urls in batches)
+
+        def worker(lk, idx, in_jobs, out_jobs, chunk_size, timeout):
+            # long lived, retries are rescheduled onto the same workers until the None sentinel arrives
+            import signal
+
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for downloader, urls in batches:
+                downloader.init_worker()
+            try:
+                for task_id, attempt in iter(in_jobs.get, None):
+                    downloader, url = tasks[task_id]
+                    budget, transforms, transport, downloader_throttle = resources[downloader]
+                    out_jobs.put(utils.multi_download_file(lk,
+                                                           idx,
+                                                           num_tasks,
+                                                           url,
+                                                           attempt,
+                                                           chunk_size,
+                                                           timeout,
+                                                           task_id,
+                                                           budget,
+                                                           transforms,
+                                                           downloader_throttle,
+                                                           transport))
+            except KeyboardInterrupt as kbi:
+                logger.warn("FAILED_TO_JOIN:KEYBOARD_INTERRUPT:{}".format(kbi))
+            except Exception as e:
+                logger.exception("WORKER_EXCEPTION:EXCEPTION:{}".format(e))
+
+        def start_worker(idx):
+            p = Process(target=worker, args=[write_lock, idx, inboxes[idx], out_queue, self.chunk_size, self.timeout])
+            p.daemon = True
+            p.start()
+            return p
+
+        processes = [start_worker(i) for i in range(len(assigned))]
+        writers = [downloader.index_writer for downloader, urls in batches]
+        turn = 0
+        lost = deque()  # failures standing in for the results of tasks held by dead workers
+        scheduled = []  # heap of (due time, task id) waiting out their backoff
+        pending = set(tasks)
+        try:
+            while pending:
+                while scheduled and scheduled[0][0] <= time.time():
+                    task_id = heappop(scheduled)[1]
+                    home[task_id].appendleft(task_id)
+                # keep every worker busy, taking the next task from each downloader in turn
+                while -1 in assigned and any(ready):
+                    while not ready[turn]:
+                        turn = (turn + 1) % len(ready)
+                    task_id = ready[turn].popleft()
+                    turn = (turn + 1) % len(ready)
+                    downloader, url = tasks[task_id]
+                    if not downloader.claim(url):
+                        downloader.claimed(url)
+                        pending.discard(task_id)
+                        continue
+                    idx = assigned.index(-1)
+                    assigned[idx] = task_id
+                    inboxes[idx].put((task_id, downloader.retry.get_attempts(task_id)))
+                # block until the next completion, waking only for a due retry, an index flush or a worker check
+                deadlines = [self.worker_check_interval] + [writer.time_to_flush() for writer in writers]
+                if scheduled:
+                    deadlines.append(scheduled[0][0] - time.time())
+                if lost:
+                    result = lost.popleft()
+                else:
+                    try:
+                        result = out_queue.get(timeout=max(min(d for d in deadlines if d is not None), 0.01))
+                    except Empty:
+                        for writer in writers:
+                            writer.poll()
+                        for idx, p in enumerate(processes):
+                            if p.is_alive():
+                                continue
+                            # a worker died (OOM kill, segfault), fail the task it held and replace it
+                            logger.error("DOWNLOAD_POOL:WORKER_DIED:{}:EXITCODE:{}".format(idx, p.exitcode))
+                            if assigned[idx] != -1:
+                                lost.append(utils.TaskResult(assigned[idx], utils.TASK_FAILED, None, 0, None, None,
+                                                             error=utils.ERROR_UNKNOWN))
+                                assigned[idx] = -1
+                            # the task may never have been taken off the dead worker's queue
+                            inboxes[idx].close()
+                            inboxes[idx] = Queue()
+                            processes[idx] = start_worker(idx)
+                        continue
+                    if result.task_id not in assigned:
+                        # late result flushed by a worker that died before it was read, its task was already failed
+                        continue
+                    assigned[assigned.index(result.task_id)] = -1
+                downloader, url = tasks[result.task_id]
+                if result.status == utils.TASK_OK:
+                    downloader.complete(url, result)
+                elif result.status == utils.TASK_NO_SPACE:
+                    # not retried within this run, the disk won't have gained room in the meantime
+                    downloader.defer(url)
+                else:
+                    delay = downloader.retry.next_delay(result.task_id, result.error)
+                    if delay is not None:
+                        logger.debug("DOWNLOAD_POOL:RETRY:{}:ERROR:{}:IN:{:0.2f}".format(url.get_path(),
+                                                                                       result.error, delay))
+                        heappush(scheduled, (time.time() + delay, result.task_id))
+                        continue
+                    downloader.fail(url, result.error, downloader.retry.get_attempts(result.task_id) - 1)
+                pending.discard(result.task_id)
+        finally:
+            for inbox in inboxes:
+                inbox.put(None)
+            for p in processes:
+                p.join(1)
+            for inbox in inboxes:
+                inbox.close()
+            out_queue.close()
@@ -0,0 +1,85 @@
+from utils import TaskResult, TASK_OK, TASK_FAILED, get_etag
+from transport import RequestsTransport
+import time
+import logging
+
+logger = logging.getLogger('Probe')
+
+
+class MetadataProbe(object):
+    """
+    Concurrent object meta-data (size, ETag) fetcher for detailed listings. Probes are single byte ranged GETs
+    (pre-signed urls are signed for GET, so HEAD isn't an option) issued from a pool of threads sharing one pooled
+    transport (the downloads' own when given, so probes and downloads reuse the same proxy tunnels), results are
+    collected as they complete rather than by polling. With concurrency at least the number of urls a listing takes
+    about one round trip.
+    """
+
+    def __init__(self, concurrency=32, timeout=3, attempts=3, transport=None):
+        """
+        :param concurrency: number of probes in flight
+        :param timeout: per probe connect/read timeout in seconds
+        :param attempts: times a failed probe is tried before giving up on it
+        :param transport: transport.Transport, with a pool of at least concurrency connections
+        """
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.attempts = attempts
+        self.transport = transport or RequestsTransport(pool_size=concurrency)
+
+    def probe(self, task):
+        """
+        :param task: tuple (task id, URL)
+        :return: TaskResult
+        """
+        task_id, url = task
+        ts = time.time()
+        try:
+            response = self.transport.get(url.get_url(), headers={'Range': 'bytes=0-0'}, timeout=self.timeout)
+            if response.status_code == 206:
+                # Content-Range: bytes 0-0/<size>
+                size = int(response.headers['Content-Range'].rpartition('/')[2])
+            elif response.status_code == 200:
+                # range ignored, the whole body was sent
+                size = int(response.headers['Content-Length'])
+            else:
+                logger.debug("PROBE:STATUS:{}:{}".format(response.status_code, url.get_path()))
+                return TaskResult(task_id, TASK_FAILED, None, time.time() - ts, None, None)
+            return TaskResult(task_id, TASK_OK, size, time.time() - ts, get_etag(response), None)
+        except Exception as e:
+            logger.debug("PROBE:FAILED:MESSAGE:{}".format(e))
+            return TaskResult(task_id, TASK_FAILED, None, time.time() - ts, None, None)
+
+    def run(self, urls):
+        """
+        Probe every url, retrying failures
+        :param urls: list of URL
+        :return: tuple (list of (URL, TaskResult) for the urls probed, list of URL that still failed)
+        """
+        from multiprocessing.pool import ThreadPool
+
+        tasks = dict(enumerate(urls))
+        pending = list(tasks)
+        results = []
+        if not pending:
+            return results, []
+        # created up front, not raced for by the threads
+        self.transport.get_session()
+        pool = ThreadPool(min(self.concurrency, len(pending)))
+        try:
+            for attempt in range(1, self.attempts + 1):
+                failed = []
+                for result in pool.imap_unordered(self.probe, [(task_id, tasks[task_id]) for task_id in pending]):
+                    if result.status == TASK_OK:
+                        results.append((tasks[result.task_id], result))
+                    else:
+                        failed.append(result.task_id)
+                logger.debug("PROBE:ATTEMPT:{}:OK:{}:FAILED:{}".format(attempt, len(pending) - len(failed),
+                                                                      len(failed)))
+                pending = failed
+                if not pending:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        return results, [tasks[task_id] for task_id in pending]
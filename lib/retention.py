@@ -0,0 +1,246 @@
+from utils import rm_files, parse_size, destination_exists, get_free_space
+from index import IndexWriter
+import os
+import logging
+
+logger = logging.getLogger('Retention')
+
+
+class RetentionEngine(object):
+    """
+    Evicts downloaded reports to keep the save directory within its limits, by age through retention_time and, when
+    max_bytes is configured, by an overall byte quota. Usage is tracked from the sizes recorded in the index at
+    download time rather than by walking the directory tree.
+    """
+
+    def __init__(self, reports, max_bytes=None, priorities=None, workers=8):
+        """
+        :param reports: Reports holding the loaded index
+        :param max_bytes: byte quota for the save directory i.e 500000000 or 500M, None to disable
+        :param priorities: report types in the order they should be evicted, unlisted types go last and ties are
+        broken oldest first
+        :param workers: number of parallel deletes
+        """
+        self.reports = reports
+        self.max_bytes = parse_size(max_bytes)
+        self.priorities = dict((report_type, rank) for rank, report_type in enumerate(priorities or []))
+        self.workers = workers
+        self.usage = None
+
+    def compute_usage(self):
+        """
+        Sum the sizes of every retained (not pruned or evicted) index entry and its derived files, data shared by
+        hardlinks is counted once however many of the entries linking it remain
+        :return: int bytes
+        """
+        usage = 0
+        inodes = set()
+        for item in self.reports.get_retained_items():
+            try:
+                stat = os.stat(item.get_destination())
+            except OSError:
+                stat = None
+            if item.get_size() is None:
+                # entries indexed before sizes were recorded
+                item.set_size(stat.st_size if stat else 0)
+            if stat is None:
+                usage += item.get_size()
+            elif (stat.st_dev, stat.st_ino) not in inodes:
+                inodes.add((stat.st_dev, stat.st_ino))
+                usage += item.get_size()
+            usage += item.get_derived_size()
+        self.usage = usage
+        logger.debug("RETENTION:USAGE:{}".format(self.usage))
+        return self.usage
+
+    def get_usage(self):
+        if self.usage is None:
+            self.compute_usage()
+        return self.usage
+
+    def record(self, index_item):
+        """
+        Account for a newly downloaded item
+        :param index_item: IndexItem
+        :return:
+        """
+        if self.usage is None:
+            return
+        if not index_item.get_linked():
+            self.usage += index_item.get_size() or 0
+        self.usage += index_item.get_derived_size()
+
+    @staticmethod
+    def released_by(item, links):
+        """
+        Bytes removing item's files releases, its file's data only once the last hardlink sharing it is removed
+        :param item: IndexItem
+        :param links: {(device, inode): links remaining} across the files being removed together
+        :return: int bytes
+        """
+        try:
+            stat = os.stat(item.get_destination())
+        except OSError:
+            return (item.get_size() or 0) + item.get_derived_size()
+        key = (stat.st_dev, stat.st_ino)
+        links[key] = links.get(key, stat.st_nlink) - 1
+        return ((item.get_size() or 0) if links[key] <= 0 else 0) + item.get_derived_size()
+
+    def releasable(self):
+        """
+        Bytes evicting every retained report would release, the most reclaim can free
+        :return: int bytes
+        """
+        links = {}
+        return sum(self.released_by(item, links) for item in self.reports.get_retained_items())
+
+    def prune(self, index_writer=None):
+        """
+        Remove reports past the retention time and then evict until usage fits within the quota
+        :param index_writer: IndexWriter to record evictions with, one is opened when not given
+        :return: bytes evicted for the quota
+        """
+        self.reports.prune_stale_reports()
+        self.compute_usage()
+        return self.evict(index_writer=index_writer)
+
+    def evict(self, bytes_needed=0, index_writer=None):
+        """
+        Evict reports, in priority then age order, until usage plus bytes_needed fits within max_bytes
+        :param bytes_needed: space about to be used by pending downloads
+        :param index_writer: IndexWriter to record evictions with, one is opened when not given
+        :return: bytes freed
+        """
+        if not self.max_bytes:
+            return 0
+        excess = self.get_usage() + bytes_needed - self.max_bytes
+        if excess <= 0:
+            return 0
+        return self.reclaim(excess, index_writer)
+
+    def reclaim(self, bytes_needed, index_writer=None):
+        """
+        Evict reports, in priority then age order, until at least bytes_needed have been freed regardless of the quota
+        :param bytes_needed:
+        :param index_writer: IndexWriter to record evictions with, one is opened when not given
+        :return: bytes freed
+        """
+        excess = bytes_needed
+        candidates = list(self.reports.get_retained_items())
+        if self.priorities:
+            # stable sort, oldest first within each priority
+            candidates.sort(key=lambda item: self.priorities.get(item.get_type(), len(self.priorities)))
+        victims = []
+        released = 0
+        links = {}
+        for item in candidates:
+            if released >= excess:
+                break
+            victims.append((item, self.released_by(item, links)))
+            released += victims[-1][1]
+        rm_files([path for item, _ in victims for path in item.get_files()], self.reports.save_path, self.workers)
+
+        # only entries whose files are all gone are evicted, the rest stay retained and counted
+        removed = [(item, size) for item, size in victims
+                   if not any(destination_exists(path) for path in item.get_files())]
+        if len(removed) < len(victims):
+            logger.warn("RETENTION:EVICT:NOT_REMOVED:{}:FILES".format(len(victims) - len(removed)))
+        freed = sum(size for _, size in removed)
+        writer = index_writer or IndexWriter(self.reports.index_path).open()
+        try:
+            for item, _ in removed:
+                item.evicted = True
+                writer.append(item.tombstone())
+        finally:
+            if index_writer is None:
+                writer.close()
+        if self.usage is not None:
+            # otherwise computed from the index, without the evicted entries, on next use
+            self.usage -= freed
+        logger.info("RETENTION:EVICTED:{}:FILES:FREED:{}:USAGE:{}:MAX_BYTES:{}".format(len(removed), freed, self.usage,
+                                                                                     self.max_bytes))
+        return freed
+
+
+class DiskBudget(object):
+    """
+    Admission control for downloads against the free space of the save directory's filesystem, less a headroom.
+    Workers reserve an object's size before writing it and release it as the bytes are written, the reservations are
+    shared between worker processes so concurrent downloads can't jointly overrun the disk.
+    Must be created before the worker processes are started.
+    """
+
+    def __init__(self, path, headroom=0):
+        """
+        :param path: save directory
+        :param headroom: bytes (or 500M style size) to always leave free
+        """
+        from multiprocessing import Value
+
+        self.path = path
+        self.headroom = parse_size(headroom) or 0
+        self.reserved = Value('d', 0)
+
+    def available(self):
+        """
+        Bytes that may still be admitted
+        :return: int
+        """
+        return int(get_free_space(self.path) - self.headroom - self.reserved.value)
+
+    def reserve(self, size):
+        """
+        :param size: bytes
+        :return: True when the space has been reserved
+        """
+        with self.reserved.get_lock():
+            if size > self.available():
+                return False
+            self.reserved.value += size
+            return True
+
+    def release(self, size):
+        with self.reserved.get_lock():
+            self.reserved.value = max(self.reserved.value - size, 0)
+
+    def plan(self, urls, retention=None, index_writer=None, offsets=None):
+        """
+        Admit the urls whose (known) sizes fit in the available space. When they don't all fit and a
+        RetentionEngine is given, reports are evicted to make room first, provided evicting can free enough for all
+        of them. Otherwise nothing is evicted and the urls that don't fit are deferred.
+        :param urls: list of URL, sizes are known when metadata was fetched, unknown sizes are left to the
+        reservation made by the worker
+        :param retention: RetentionEngine or None to only defer
+        :param index_writer:
+        :param offsets: dict {URL.meta.path: bytes already downloaded} of resumed objects, only the rest is needed
+        :return: tuple (admitted urls, deferred urls)
+        """
+        offsets = offsets or {}
+
+        def remaining(url):
+            return max((url.get_size() or 0) - offsets.get(url.meta.path, 0), 0)
+
+        needed = sum(remaining(url) for url in urls)
+        available = self.available()
+        if needed > available and retention is not None:
+            releasable = retention.releasable()
+            if needed - available <= releasable:
+                logger.warn("DISK_BUDGET:LOW_SPACE:NEEDED:{}:AVAILABLE:{}:PRUNING".format(needed, available))
+                retention.reclaim(needed - available, index_writer)
+                available = self.available()
+            else:
+                # the space is held by something other than the reports, evicting them all wouldn't make room
+                logger.warn("DISK_BUDGET:LOW_SPACE:NEEDED:{}:AVAILABLE:{}:RELEASABLE:{}:NOT_PRUNING".format(
+                    needed, available, releasable))
+        if needed <= available:
+            return urls, []
+        admitted, deferred = [], []
+        for url in urls:
+            size = remaining(url)
+            if size <= available:
+                admitted.append(url)
+                available -= size
+            else:
+                deferred.append(url)
+        logger.warn("DISK_BUDGET:LOW_SPACE:DEFERRING:{}:OF:{}".format(len(deferred), len(urls)))
+        return admitted, deferred
@@ -0,0 +1,57 @@
+from utils import ERROR_TIMEOUT, ERROR_SERVER, ERROR_EXPIRED, ERROR_IO, ERROR_REJECTED, ERROR_INTERRUPTED, \
+    ERROR_UNKNOWN
+import random
+import logging
+
+logger = logging.getLogger('Retry')
+
+
+class RetryPolicy(object):
+    """
+    Per object retry state. Each failed object is retried on its own after an exponential backoff with full jitter
+    (a random delay between 0 and base_delay * 2 ** failures, capped at max_delay) so retries spread out rather than
+    hammering S3 in lock step during a brownout. Every class of error has its own budget of retries per object.
+    """
+    default_budgets = {
+        ERROR_TIMEOUT: 4,
+        ERROR_SERVER: 5,
+        # an expired pre-signed url fails identically until it is re-signed from a fresh report listing
+        ERROR_EXPIRED: 0,
+        ERROR_IO: 2,
+        ERROR_REJECTED: 0,
+        ERROR_INTERRUPTED: 0,
+        ERROR_UNKNOWN: 1,
+    }
+
+    def __init__(self, budgets=None, base_delay=0.5, max_delay=30):
+        """
+        :param budgets: {error class: retries} overriding default_budgets i.e {'timeout': 2, 'server': 8}
+        :param base_delay: seconds
+        :param max_delay: seconds
+        """
+        self.budgets = dict(self.default_budgets, **(budgets or {}))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = {}  # key -> {error class: failures}
+
+    def get_attempts(self, key):
+        """
+        :return: number of attempts made on key so far
+        """
+        return sum(self.failures.get(key, {}).values()) + 1
+
+    def next_delay(self, key, error):
+        """
+        Record a failure of key and decide whether it is retried
+        :param key: object identifier, i.e the task id
+        :param error: utils.ERROR_* class of the failure
+        :return: seconds to wait before the retry, or None when the budget for that class of error is spent
+        """
+        error = error or ERROR_UNKNOWN
+        failures = self.failures.setdefault(key, {})
+        failures[error] = failures.get(error, 0) + 1
+        if failures[error] > self.budgets.get(error, 0):
+            logger.debug("RETRY:BUDGET_SPENT:{}:ERROR:{}:FAILURES:{}".format(key, error, failures[error]))
+            return None
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (sum(failures.values()) - 1))
+        return random.uniform(0, ceiling)
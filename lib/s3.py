@@ -1,10 +1,17 @@
 from lib import utils
 import logging
-import time
-from multiprocessing import Queue, Process, freeze_support, Lock
-from Queue import Empty
-import tqdm
-from .models import IndexItem, URL, Reports
+from .models import IndexItem, URL, Reports, ReportFilter, Proxy
+from .index import IndexWriter
+from .retention import RetentionEngine, DiskBudget
+from .transforms import Pipeline
+from .probe import MetadataProbe
+from .cache import MetadataCache
+from .retry import RetryPolicy
+from .journal import DownloadJournal
+from .pool import DownloadPool
+from .shard import Shard
+from .lock import RunLock, ObjectClaim
+from .transport import create_transport
 
 logger = logging.getLogger('S3Downloader')
 
@@ -16,22 +23,153 @@ class S3Downloader:
     """
 
     @utils.logthis(logger, logging.INFO)
-    def __init__(self, config, urls=None):
+    def __init__(self, config, urls=None, transport=None):
         if utils.is_writable(config['directory']):
             self.save_path = config['directory']
         else:
             raise Exception("CANNOT_WRITE_TO_DIRECTORY: {}".format(config['directory']))
+        # the components only a download run needs (metadata cache, shard membership, run lock, journal, retention,
+        # transforms, transport) are built from config on first use, listings from the index alone never pay for them
+        self.config = config
         self.chunk_size = 8096
         self.timeout = 20
-        self.meta_timeout = 3
+        # detailed listings probe every object, meta_concurrency of them in flight at once
+        self.meta_timeout = config.get('meta_timeout', 3)
+        self.meta_concurrency = config.get('meta_concurrency', 32)
+        self._metadata_cache = None
         self.workers = 10
+        # shared with other downloaders when given (tenants of one process), see get_transport_settings
+        self._transport = transport
+        # seconds between checks that no worker has died while the coordinator waits on completions
+        self.worker_check_interval = 1.0
         self.urls = urls
-        self.queue = Queue()
-        self.index_path = "{}/{}".format(self.save_path, 'history.index')
+        self.queue = None
+        # cluster mode, every node downloads the share of the urls the hash ring assigns to it and keeps its own
+        # history.<node>.index and journal, see lib/shard.py
+        self._shard = None
+        self.node = Shard.get_node_name(config['shard'].get('node')) if config.get('shard') else None
+        self.suffix = ".{}".format(self.node) if self.node else ''
+        self.index_path = "{}/history{}.index".format(self.save_path, self.suffix)
         self.index_lmt = utils.get_file_modified_time(self.index_path)
         self.retention_time = config['retention_time']
+        self.index_flush_interval = config.get('index_flush_interval', 1.0)
+        self.index_fsync = config.get('index_fsync', False)
         self.reports = Reports(self.save_path, self.index_path, self.retention_time)
         self.index = self.reports.load_index()
+        # batch in progress, lets an interrupted run resume rather than replan
+        self._journal = None
+        # runs overlapping on the save directory (cron, service, manual) wait for each other, skip or attach and
+        # split the objects through per object claims, see lib/lock.py
+        self._run_lock = None
+        self.claims = config.get('run_lock', RunLock.WAIT) == RunLock.ATTACH
+        # this run holds the lock or is attached to the run holding it, a skipped run leaves everything to that run
+        self.locked = False
+        self.object_claims = {}  # destination -> ObjectClaim held by this run
+        self._retention = None
+        # free space always kept on the save directory's filesystem, when downloads won't fit either leave them for
+        # a later run ('defer') or, opted into, evict reports to make room ('prune')
+        self.min_free_bytes = config.get('min_free_bytes', '100M')
+        self.low_space_action = config.get('low_space_action', 'defer')
+        self.deferred_urls = []
+        self.failed_urls = []
+        self.budget = None
+        self.index_writer = None
+        self.retry = None
+        # download rate of this downloader's objects in bytes/s (i.e 50M), unlimited when not set. Enforced by the
+        # pool, within its own budget when the pool is shared between tenants
+        self.max_bandwidth = config.get('max_bandwidth')
+        # identical objects (by ETag or content md5) are hardlinked to the copy already stored instead of kept twice
+        self.deduplicate = config.get('deduplicate', True)
+        # failed objects are retried individually after a jittered exponential backoff, within a budget per class
+        # of error (timeout, server, expired, io, see lib/retry.py)
+        self.retry_budgets = config.get('retry_budgets')
+        self.retry_base_delay = config.get('retry_base_delay', 0.5)
+        self.retry_max_delay = config.get('retry_max_delay', 30)
+        # stages the downloaded bytes are teed into, see lib/transforms.py
+        self._transforms = None
+        # report types this deployment consumes (include_types, all when not set) minus exclude_types, the urls of
+        # the others are never built, downloaded or listed
+        self._report_filter = None
+
+    @property
+    def metadata_cache(self):
+        if self._metadata_cache is None:
+            self._metadata_cache = MetadataCache("{}/{}".format(self.save_path, 'metadata.cache'),
+                                                 self.config.get('meta_cache_ttl', '30d'),
+                                                 self.config.get('meta_cache_size', 100000)).load()
+        return self._metadata_cache
+
+    @property
+    def transport(self):
+        # downloads and probes share kept alive connections, through the proxies of the proxy section when given.
+        # transport 'requests' or 'socket' (raw sockets, see lib/transport.py), receive_buffer sets SO_RCVBUF.
+        # Its counters are shared with the workers, so it is created before they are forked (see open_batch)
+        if self._transport is None:
+            self._transport = self.build_transport(self.config, max(self.meta_concurrency, self.workers))
+        return self._transport
+
+    @staticmethod
+    def get_transport_settings(config):
+        """
+        :param config: save section
+        :return: dict of the settings a transport is built with
+        """
+        return {'transport': config.get('transport', 'requests'), 'proxy': config.get('proxy'),
+                'receive_buffer': config.get('receive_buffer'), 'tcp_nodelay': config.get('tcp_nodelay', True),
+                'dns_cache_ttl': config.get('dns_cache_ttl', 300)}
+
+    @classmethod
+    def build_transport(cls, config, pool_size):
+        """
+        :param config: save section
+        :param pool_size: connections kept alive per endpoint
+        :return: transport.Transport
+        """
+        settings = cls.get_transport_settings(config)
+        return create_transport(settings['transport'], Proxy.from_config(settings['proxy']), pool_size,
+                                receive_buffer=settings['receive_buffer'], nodelay=settings['tcp_nodelay'],
+                                dns_ttl=settings['dns_cache_ttl'])
+
+    @property
+    def shard(self):
+        if self._shard is None and self.node is not None:
+            self._shard = Shard.from_config(dict(self.config['shard'], node=self.node))
+        return self._shard
+
+    @property
+    def journal(self):
+        if self._journal is None:
+            self._journal = DownloadJournal("{}/download{}.journal".format(self.save_path, self.suffix),
+                                            self.save_path, self.index_fsync)
+        return self._journal
+
+    @property
+    def run_lock(self):
+        if self._run_lock is None:
+            self._run_lock = RunLock("{}/run{}.lock".format(self.save_path, self.suffix),
+                                     self.config.get('run_lock', RunLock.WAIT), self.config.get('run_lock_timeout'))
+        return self._run_lock
+
+    @property
+    def retention(self):
+        if self._retention is None:
+            self._retention = RetentionEngine(self.reports,
+                                              self.config.get('max_bytes'),
+                                              self.config.get('eviction_priority'),
+                                              self.config.get('prune_workers', 8))
+        return self._retention
+
+    @property
+    def transforms(self):
+        if self._transforms is None:
+            self._transforms = Pipeline(self.config.get('transforms'))
+        return self._transforms
+
+    @property
+    def report_filter(self):
+        if self._report_filter is None:
+            self._report_filter = ReportFilter.from_config(self.config)
+        return self._report_filter
 
     def download_reports(self, reports):
         """
@@ -44,18 +182,28 @@ class S3Downloader:
         ]
         :return:
         """
+        self.add_reports(reports)
+        return self.download_urls()
+
+    def add_reports(self, reports):
+        """
+        Merge freshly listed reports into the ones managed here and prune what fell out of retention
+        :param reports: Reports
+        """
         # TODO: make the Reports object responsible for de-duping and managing the index read/write
+        dropped = reports.select_types(self.report_filter)
+        if dropped:
+            logger.debug("DOWNLOAD_REPORTS:TYPES_NOT_SELECTED:URLS:{}".format(dropped))
         for id, report in reports.reports.items():
             self.reports.add(report)
-        self.reports.prune_stale_reports()
-        return self.download_urls()
+        self.retention.prune()
 
     def download_urls(self):
         """
         Download a set of urls
-        Will attempt to download failed urls twice, after this it will return a list of urls still not downloaded.
-        The scenario where this will occur is when it takes longer than 15 minutes for the workers to start downloading
-        all files. If this happens then the pre-signged aws URLS will no longer be valid. The returned URLS will
+        Failed urls are retried individually, see RetryPolicy, once their retries are spent a list of the urls still
+        not downloaded is returned. The usual scenario is when it takes longer than 15 minutes for the workers to start
+        downloading all files. If this happens then the pre-signged aws URLS will no longer be valid. The returned URLS will
         trigger the above manager to re-run the download_urls function, but in doing so will be fetching fresh
         pre-signed urls. The above manager will handle the refining down of the report summary to ensure only the desired
         URLS are to be processed.
@@ -77,189 +225,311 @@ class S3Downloader:
         ]
         :return:
         """
+        return DownloadPool(self.workers, self.chunk_size, self.timeout,
+                            worker_check_interval=self.worker_check_interval).download([self])[0]
+
+    def open_batch(self):
+        """
+        Plan the next batch: recover an interrupted one, link objects already stored, admit what fits on disk and
+        journal the rest. The index writer stays open until close_batch.
+        :return: list of URL to download, None when no url is downloadable or another run holds the directory
+        """
+        self.locked = self.run_lock.acquire() or self.run_lock.is_attached()
+        if not self.locked:
+            logger.warn("DOWNLOAD_REPORTS:RUN_IN_PROGRESS:SKIPPING:{}".format(self.save_path))
+            return None
+        if self.run_lock.contended:
+            # the other run has been adding to the index since it was loaded
+            self.reload_index()
+        self.journal.enabled = not self.run_lock.is_attached()
+        unfinished = self.recover_journal()
+        self.deferred_urls = []
+        self.failed_urls = []
+        self.retry = RetryPolicy(self.retry_budgets, self.retry_base_delay, self.retry_max_delay)
         urls = self.reports.get_downloadable_urls()
+        if urls and self.shard is not None:
+            urls = self.shard.select(urls)
+        offsets = self.resume_unfinished(unfinished, urls)
         if not urls:
+            return None
+        # the coordinator is the only process writing to the index, workers just report completions
+        self.index_writer = IndexWriter(self.index_path, self.index_flush_interval, fsync=self.index_fsync).open()
+        urls = self.link_duplicates(urls, self.index_writer)
+        if urls:
+            self.budget = DiskBudget(self.save_path, self.min_free_bytes)
+            urls, self.deferred_urls = self.budget.plan(urls,
+                                                        self.retention if self.low_space_action == 'prune' else None,
+                                                        self.index_writer, offsets)
+        if urls:
+            self.journal.queue(urls)
+            logger.info("DOWNLOAD_REPORTS:URL:NUM_TASKS:{}".format(len(urls)))
+        return urls
+
+    def reload_index(self):
+        self.index = self.reports.load_index()
+        if self._retention is not None:
+            # the other run may have downloaded or evicted reports since
+            self._retention.compute_usage()
+
+    def init_worker(self):
+        """
+        Called in every worker process once it is forked
+        """
+        # the locks belong to the coordinator, a worker outliving it must not keep holding them
+        if self._run_lock is not None:
+            self._run_lock.release()
+        if self._shard is not None:
+            self._shard.membership.leave()
+
+    def complete(self, url, result):
+        """
+        Record a completed download
+        :param url: URL
+        :param result: TaskResult
+        """
+        url = self.reports.apply_result(url, result)
+        self.metadata_cache.put(url)
+        index_item = IndexItem(url.get_path(), result.size, url.get_type(), result.etag, result.digest,
+                               result.rows, result.header, result.derived)
+        self.link_duplicate_item(index_item)
+        self.reports.add_index_item(index_item)
+        self.retention.record(index_item)
+        self.index_writer.append(index_item)
+        self.journal.done(url, index_item)
+        self.release_claim(url)
+
+    def claim(self, url):
+        """
+        Claim a url before it is handed to a worker, when runs attached to the save directory split the objects
+        between them. Claims are held until the object's index entry is written.
+        :param url: URL
+        :return: False when another run holds the claim or has already downloaded the object
+        """
+        if not self.claims or url.get_path() in self.object_claims:
+            return True
+        claim = ObjectClaim(url.get_path())
+        if not claim.acquire():
+            return False
+        # the claim may just have been released by a run that completed the object
+        self.reports.refresh_index()
+        if self.reports.destination_in_index(url.get_path()):
+            claim.release()
+            return False
+        self.object_claims[url.get_path()] = claim
+        return True
+
+    def release_claim(self, url):
+        claim = self.object_claims.pop(url.get_path(), None)
+        if claim is not None:
+            # another run may claim it next, it must find the index entry
+            self.index_writer.flush()
+            claim.release()
+
+    def claimed(self, url):
+        """
+        A url left to the attached run that claimed it, which downloads and indexes it
+        :param url: URL
+        """
+        logger.debug("DOWNLOAD_REPORTS:CLAIMED_ELSEWHERE:{}".format(url.get_path()))
+        self.journal.claimed(url)
+
+    def fail(self, url, error, attempts):
+        """
+        Give up on a url whose retries are spent
+        :param url: URL
+        :param error: utils.ERROR_* class of the last failure
+        :param attempts: number of attempts made
+        """
+        logger.warn("DOWNLOAD_REPORTS:FAILED:{}:ERROR:{}:ATTEMPTS:{}".format(url.get_path(), error, attempts))
+        if error == utils.ERROR_REJECTED:
+            # everything else stays queued in the journal, to be resumed with a re-signed url
+            self.journal.failed(url)
+        self.failed_urls.append(url)
+        self.release_claim(url)
+
+    def defer(self, url):
+        """
+        Leave a url that didn't fit on disk for a later run
+        :param url: URL
+        """
+        self.deferred_urls.append(url)
+        self.release_claim(url)
+
+    def get_batch_result(self, urls):
+        """
+        :param urls: the urls open_batch returned
+        :return: 0 when nothing was downloadable, the urls that failed or Reports
+        """
+        if urls is None:
             return 0
-        try:
-            attempt = 1
-            while urls:
-                num_tasks = len(urls)
-                logger.info("DOWNLOAD_REPORTS:RUN:{}".format(attempt))
-                logger.info("DOWNLOAD_REPORTS:URL:NUM_TASKS:{}".format(num_tasks))
-                failed_urls = []
-                freeze_support()
-                write_lock = Lock()
-                in_queue = Queue(num_tasks)
-                fail_queue = Queue(num_tasks)
-                out_queue = Queue(num_tasks)
-
-                tqdm.tqdm.write("|   DOWNLOADING {} FILES".format(num_tasks))
-
-                def worker(lk, idx, in_jobs, out_jobs, fail_jobs, history_file, chunk_size, timeout):
-                    try:
-                        while True:
-                            url_obj = in_jobs.get_nowait()
-                            success = utils.multi_download_file(lk,
-                                                                idx,
-                                                                num_tasks,
-                                                                url_obj,
-                                                                attempt,
-                                                                chunk_size,
-                                                                timeout)
-                            if isinstance(success, URL):
-                                out_jobs.put_nowait(success)
-                                lk.acquire()
-                                self.reports.append_index(IndexItem(url_obj.get_path()))
-                                lk.release()
-
-                            else:
-                                fail_jobs.put_nowait(url_obj)
-                    except Empty:
-                        logger.debug("WORKER:QUEUE_EMPTY:WORKER:PID:{}:NAME:{}".format(p.pid, p.name))
-                        return None
-                    except KeyboardInterrupt as kbi:
-                        logger.warn("FAILED_TO_JOIN:KEYBOARD_INTERRUPT:{}".format(kbi))
-                        return
-                    except Exception as e:
-                        logger.exception("WORKER_EXCEPTION:EXCEPTION:{}".format(e))
-                        return None
-
-                if fail_queue.empty():
-                    for url in urls:
-                        in_queue.put(url, timeout=1)
-                else:
-                    while not fail_queue.empty():
-                        failed_urls.append(fail_queue.get())
-
-                urls = failed_urls
-                if attempt > 2:
-                    self.reports.set_downloaded(False)
-                    raise utils.ExcessiveDownloadAttempts()
-
-                processes = []
-                for i in range(0, self.workers):
-                    p = Process(target=worker,
-                                args=[write_lock, i, in_queue, out_queue, fail_queue, self.index_path, self.chunk_size,
-                                      self.timeout])
-                    p.daemon = True
-                    p.start()
-                    processes.append(p)
-
-                while True:
-                    try:
-                        url = out_queue.get_nowait()
-                        self.reports.update_url(url)
-                    except Empty:
-                        time.sleep(.2)
-                    if not any(p.is_alive() for p in processes) and out_queue.empty() and fail_queue.empty():
-                        # all the workers are done and nothing is in the queue
-                        logger.debug("DONE:PROCESS_STATUS:{}".format([p.is_alive() for p in processes]))
-                        out_queue.close()
-                        fail_queue.close()
-                        in_queue.close()
-                        self.reports.set_downloaded(True)
-                        return self.reports
-                    elif not fail_queue.empty():
-                        while not fail_queue.empty():
-                            failed_urls.append(fail_queue.get())
-                        urls = failed_urls
-                        attempt += 1
-                        self.reports.set_downloaded(False)
-                        break
-                attempt += 1
-        except utils.ExcessiveDownloadAttempts:
-            logger.exception("DOWNLOAD_REPORTS:EXCESSIVE_ATTEMPTS_MADE:REFRESHING_PRE_SIGNED_URLS")
+        if self.failed_urls:
+            logger.error("DOWNLOAD_REPORTS:EXCESSIVE_ATTEMPTS_MADE:{}:REFRESHING_PRE_SIGNED_URLS".format(
+                len(self.failed_urls)))
+            self.reports.set_downloaded(False)
             # TODO: do a pre-signed refresh here and rerun-download as required
+            return self.failed_urls
+        # nothing admitted, everything deferred for lack of space
+        self.reports.set_downloaded(bool(urls) or not self.deferred_urls)
+        return self.reports
+
+    def close_batch(self):
+        if not self.locked:
+            # skipped, the journal, metadata cache and index belong to the run holding the directory
+            if self._run_lock is not None:
+                self._run_lock.release()
+            return
+        self.locked = False
+        for claim in self.object_claims.values():
+            claim.release()
+        self.object_claims = {}
+        if self.index_writer is not None:
+            self.index_writer.close()
+            self.index_writer = None
+        self.journal.close()
+        self.metadata_cache.save()
+        self.run_lock.release()
+        metrics = self.get_metrics()
+        logger.info("DOWNLOAD_REPORTS:TRANSPORT:{}:REQUESTS:{}:CONNECTIONS:{}:DNS_LOOKUPS:{}:TUNNELS:{}:"
+                    "TUNNEL_AVG_MS:{:0.1f}".format(self.transport.name.upper(), metrics['requests'],
+                                                   metrics['connections'], metrics['dns_lookups'], metrics['tunnels'],
+                                                   metrics['tunnel_avg_ms']))
+
+    def get_metrics(self):
+        """
+        Transport metrics of this downloader's runs, downloads and metadata probes from every worker included
+        :return: dict, see transport.TransportStats.get_metrics
+        """
+        return self.transport.get_metrics()
+
+    def recover_journal(self):
+        """
+        Replay the journal of an interrupted run. Objects it completed whose index entries were lost are indexed
+        (after verifying their md5) without being downloaded again, partially downloaded objects resume from their
+        .part files once their (freshly signed) urls are downloaded.
+        :return: dict {key: bytes already downloaded} of the objects still unfinished, keys are URL.meta.path
+        """
+        self.journal.replay()
+        recovered = [record for record in self.journal.get_completed()
+                     if not self.reports.destination_in_index(self.journal.get_destination(record['key']))]
+        if recovered:
+            with IndexWriter(self.index_path, fsync=self.index_fsync) as index_writer:
+                for record in recovered:
+                    index_item = IndexItem(self.journal.get_destination(record['key']), record.get('size'),
+                                           record.get('type'), record.get('etag'), record.get('md5'),
+                                           record.get('rows'), record.get('header'), record.get('derived'))
+                    index_item.set_linked(record.get('linked', False))
+                    self.reports.add_index_item(index_item)
+                    self.retention.record(index_item)
+                    index_writer.append(index_item)
+            logger.info("JOURNAL:RECOVERED:{}".format(len(recovered)))
+        return self.journal.get_unfinished()
+
+    def resume_unfinished(self, unfinished, urls):
+        """
+        Resume the objects an interrupted run left unfinished that are listed again, their downloads pick up from
+        the .part files. The others are dropped along with their .part files rather than staying journaled.
+        :param unfinished: see recover_journal
+        :param urls: list of URL planned for this run
+        :return: dict {key: bytes already downloaded} of the objects resumed
+        """
+        if not unfinished:
+            return {}
+        listed = set(url.meta.path for url in urls)
+        resumed = dict((key, offset) for key, offset in unfinished.items() if key in listed)
+        dropped = [key for key in unfinished if key not in listed]
+        if dropped:
+            self.journal.dropped(dropped)
+        logger.info("JOURNAL:RESUMING:{}:BYTES:{}:DROPPED:{}".format(len(resumed), sum(resumed.values()),
+                                                                    len(dropped)))
+        return resumed
+
+    def list_local_reports(self, types=None, start=None, end=None, detailed=False):
+        """
+        Display the reports already downloaded, from the index only (no network access)
+        :param types: list of report types, None for the types selected by include_types/exclude_types
+        :param start: datetime, first report period
+        :param end: datetime, report periods before
+        :param detailed: include sizes and per type file/size/row totals
+        :return: Reports
+        """
+        from .catalog import Catalog
+
+        return Catalog(self.reports).display(types or self.report_filter.types, start, end, detailed,
+                                             self.report_filter.exclude_types)
+
+    def get_report_filter(self, **criteria):
+        """
+        ReportFilter to parse report listings with, so the urls of the report types not selected are never built
+        :param criteria: report_numbers, recent, start, end, see ReportFilter
+        :return: ReportFilter
+        """
+        return ReportFilter.from_config({'include_types': self.report_filter.types,
+                                         'exclude_types': self.report_filter.exclude_types}, **criteria)
+
+    def link_duplicates(self, urls, index_writer):
+        """
+        Satisfy urls whose ETag (known once metadata has been fetched) matches an object already stored by linking
+        to it rather than transferring it again
+        :param urls: list of URL
+        :param index_writer: IndexWriter
+        :return: list of URL still to be downloaded
+        """
+        if not self.deduplicate:
             return urls
+        remaining = []
+        for url in urls:
+            source = self.reports.index.find_content(url.get_etag())
+            if source is None or not utils.link_file(source.get_destination(), url.get_path()):
+                remaining.append(url)
+                continue
+            index_item = IndexItem(url.get_path(), source.get_size(), url.get_type(), source.get_etag(),
+                                   source.get_digest(), source.get_rows(), source.get_header())
+            index_item.set_linked(True)
+            url.set_size(source.get_size())
+            self.reports.add_index_item(index_item)
+            self.retention.record(index_item)
+            index_writer.append(index_item)
+        if len(remaining) < len(urls):
+            logger.info("DOWNLOAD_REPORTS:DEDUPLICATED:{}:OF:{}".format(len(urls) - len(remaining), len(urls)))
+        return remaining
+
+    def link_duplicate_item(self, index_item):
+        """
+        Replace a freshly downloaded file with a link to an identical one already stored
+        :param index_item: IndexItem of the download, not yet added to the index
+        :return: True when linked
+        """
+        if not self.deduplicate:
+            return False
+        source = self.reports.index.find_content(index_item.get_etag(), index_item.get_digest())
+        if source is None or source.get_destination() == index_item.get_destination():
+            return False
+        if utils.link_file(source.get_destination(), index_item.get_destination()):
+            index_item.set_linked(True)
+            return True
+        return False
 
     def get_reports_meta(self, reports = None):
         """
-        Multiprocess fetch the header content from the given list of urls and return this meta-information.
-        Metadata is updated on the Report object via the update() method which will hydrate the object with
-        any additional properties that are discovered when a url dictionary is passed into the update method.
+        Fill in the size and ETag of every url from the metadata cache, concurrently probing the objects it doesn't
+        know, updating the URL objects of the Reports in place.
         :param reports:
-        :return:
+        :return: Reports
         """
         if reports:
             self.reports = reports
         if not self.reports:
             raise Exception("No reports available")
+        self.reports.select_types(self.report_filter)
         urls = self.reports.get_urls()
-        print(urls)
-        workers = 10
-        urls_meta = []
-        try:
-            attempt = 1
-            while urls:
-                num_tasks = len(urls)
-                failed_urls = []
-                freeze_support()
-                write_lock = Lock()
-                in_queue = Queue(num_tasks * 2)
-                out_queue = Queue(num_tasks * 2)
-                fail_queue = Queue(num_tasks * 2)
-
-                def worker(lk, idx, in_jobs, out_jobs, fail_jobs, timeout):
-                    try:
-                        while True:
-
-                            url_item = in_jobs.get_nowait()
-                            url_with_meta = utils.multi_content_fetch(lk,
-                                                                      idx,
-                                                                      num_tasks,
-                                                                      url_item,
-                                                                      attempt,
-                                                                      timeout)
-                            if isinstance(url_with_meta, URL):
-                                logger.debug("WORKER:URL:SUCCESS")
-                                out_jobs.put_nowait(url_with_meta)
-
-                            else:
-                                logger.debug("WORKER:URL:FAILURE")
-                                fail_jobs.put(url_item, block=False, timeout=1)
-                    except Empty:
-                        logger.debug("WORKER:QUEUE:EMPTY")
-                        # return
-
-                if fail_queue.empty():
-                    for url in urls:
-                        in_queue.put_nowait(url)
-
-                if attempt > 2:
-                    raise utils.ExcessiveDownloadAttempts()
-
-                processes = []
-                for i in range(0, workers):
-                    p = Process(target=worker, args=[write_lock, i, in_queue, out_queue, fail_queue, self.meta_timeout])
-                    p.daemon = True
-                    p.start()
-                    processes.append(p)
-                while True:
-                    try:
-                        url = out_queue.get_nowait()
-                        self.reports.update_url(url)
-
-                    except Empty:
-                        time.sleep(.2)
-                    finally:
-                        if not any(p.is_alive() for p in processes) and out_queue.empty() and fail_queue.empty():
-                            # all the workers are done and nothing is in the queue
-                            logger.debug("DONE:PROCESS_STATUS:{}".format([p.is_alive() for p in processes]))
-                            out_queue.close()
-                            fail_queue.close()
-                            in_queue.close()
-                            return self.reports
-                        elif not fail_queue.empty():
-                            while not fail_queue.empty():
-                                failed_urls.append(fail_queue.get())
-                            urls = failed_urls
-                            attempt += 1
-                            break
-
-
-
-
-        except utils.ExcessiveDownloadAttempts:
-            logger.exception("DOWNLOAD_META:EXCESSIVE_ATTEMPTS_MADE")
-            # TODO: do a pre-signed refresh here and rerun-download as required
-            return urls_meta
\ No newline at end of file
+        # only objects the cache doesn't know are probed
+        unknown = [url for url in urls if not self.metadata_cache.fill(url)]
+        logger.debug("DOWNLOAD_META:CACHED:{}:PROBING:{}".format(len(urls) - len(unknown), len(unknown)))
+        results, failed = MetadataProbe(self.meta_concurrency, self.meta_timeout,
+                                        transport=self.transport).run(unknown)
+        for url, result in results:
+            self.metadata_cache.put(self.reports.apply_result(url, result))
+        self.metadata_cache.save()
+        if failed:
+            logger.warn("DOWNLOAD_META:FAILED:{}:OF:{}".format(len(failed), len(urls)))
+        return self.reports
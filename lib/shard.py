@@ -0,0 +1,226 @@
+from utils import make_sure_path_exists, destination_exists
+from index import read_watermark, write_watermark
+from models import IndexItem
+from lock import try_flock
+from bisect import bisect
+import json
+import os
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger('Shard')
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of node names. Every node is placed at replicas points on the ring and a key belongs to the
+    first node point at or after the key's hash, so adding or removing one of N nodes only moves about 1/N of the keys.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        """
+        :param nodes: list of node names
+        :param replicas: points per node, more spreads the keys more evenly
+        """
+        self.nodes = sorted(set(nodes))
+        self.ring = sorted((self.hash("{}#{}".format(node, i)), node) for node in self.nodes for i in range(replicas))
+        self.points = [point for point, node in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """
+        :param key: i.e URL.meta.path
+        :return: name of the node owning key
+        """
+        return self.ring[bisect(self.points, self.hash(key)) % len(self.ring)][1]
+
+
+class Membership(object):
+    """
+    Nodes taking part in a sharded download, either a static list of names or discovered from a directory shared by
+    the nodes (a local directory for instances on one host, or a network filesystem honouring flock). A running node
+    holds an exclusive flock on <directory>/<node>.lock, a lock file nobody holds is left by a node that stopped.
+    """
+
+    def __init__(self, node, nodes=None, directory=None, settle=1.0):
+        """
+        :param node: name of this node
+        :param nodes: static list of node names, discovery through directory when not given
+        :param directory: membership directory
+        :param settle: seconds to wait after joining before reading the members, so nodes started together see
+        each other
+        """
+        self.node = node
+        self.nodes = nodes
+        self.directory = directory
+        self.settle = settle
+        self.handle = None
+        self.joined = None
+
+    def get_lock_path(self, node):
+        return os.path.join(self.directory, "{}.lock".format(node))
+
+    def join(self):
+        """
+        Announce this node in the membership directory for as long as the process lives
+        :return: self
+        """
+        if self.directory is None or self.handle is not None:
+            return self
+        make_sure_path_exists(self.directory)
+        self.handle = open(self.get_lock_path(self.node), 'a')
+        if not try_flock(self.handle):
+            self.handle.close()
+            self.handle = None
+            raise Exception("SHARD_NODE_ALREADY_RUNNING: {}".format(self.node))
+        self.joined = time.time()
+        logger.info("SHARD:JOINED:{}:DIRECTORY:{}".format(self.node, self.directory))
+        return self
+
+    def leave(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def is_alive(self, node):
+        """
+        :param node: name of another node
+        :return: True while the node holds its lock
+        """
+        with open(self.get_lock_path(node), 'a') as f:
+            return not try_flock(f, exclusive=False)
+
+    def get_nodes(self):
+        """
+        :return: sorted list of the names of the live nodes, this one included
+        """
+        if self.nodes:
+            return sorted(set(self.nodes) | {self.node})
+        self.join()
+        wait = self.settle - (time.time() - self.joined)
+        if wait > 0:
+            time.sleep(wait)
+        nodes = {self.node}
+        for filename in os.listdir(self.directory):
+            node, extension = os.path.splitext(filename)
+            if extension == '.lock' and node not in nodes and self.is_alive(node):
+                nodes.add(node)
+        return sorted(nodes)
+
+
+class Shard(object):
+    """
+    Deterministic partitioning of the planned urls between the nodes of a cluster, without a coordinator: every
+    node computes the same ring from the same membership and keeps the urls whose URL.meta.path hashes to itself.
+    A node that stops has its share picked up by the others on their next run.
+    """
+
+    def __init__(self, node=None, nodes=None, directory=None, replicas=100, settle=1.0):
+        """
+        :param node: name of this node, defaults to the host name
+        :param nodes: static list of node names
+        :param directory: membership directory, see Membership
+        :param replicas: see HashRing
+        :param settle: see Membership
+        """
+        node = self.get_node_name(node)
+        if not nodes and not directory:
+            raise Exception("SHARD_MEMBERSHIP_NOT_CONFIGURED: shard needs either nodes or directory")
+        self.node = node
+        self.replicas = replicas
+        self.membership = Membership(node, nodes, directory, settle).join()
+
+    @staticmethod
+    def get_node_name(node=None):
+        """
+        :param node: configured node name
+        :return: node, the host name when not configured
+        """
+        if node is None:
+            import socket
+
+            node = socket.gethostname()
+        return node
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: shard section {'node': 'host-a', 'nodes': [...], 'directory': '/shared/members', ...}
+        :return: Shard
+        """
+        return cls(config.get('node'), config.get('nodes'), config.get('directory'), config.get('replicas', 100),
+                   config.get('settle', 1.0))
+
+    def get_ring(self):
+        return HashRing(self.membership.get_nodes(), self.replicas)
+
+    def select(self, urls):
+        """
+        :param urls: list of URL
+        :return: list of the URL owned by this node
+        """
+        ring = self.get_ring()
+        selected = [url for url in urls if ring.get_node(url.meta.path) == self.node]
+        logger.info("SHARD:NODE:{}:NODES:{}:SELECTED:{}:OF:{}".format(self.node, ','.join(ring.nodes),
+                                                                     len(selected), len(urls)))
+        return selected
+
+
+def get_index_shard_paths(save_path):
+    """
+    :param save_path: save directory shared by the nodes
+    :return: sorted list of the history.<node>.index shards in it
+    """
+    return sorted(os.path.join(save_path, filename) for filename in os.listdir(save_path)
+                  if filename.startswith('history.') and filename.endswith('.index') and filename != 'history.index')
+
+
+def merge_indexes(paths, destination):
+    """
+    Merge per node index shards into one combined index, ordered by download time. Each shard is already time
+    ordered, so this is a streaming k-way merge. An object indexed by more than one node (its share moved after a
+    membership change) is kept once, as first downloaded. The combined watermark is the lowest of the shards'
+    watermarks, so no entry still retained by its node is hidden.
+    :param paths: list of index shard paths
+    :param destination: combined index path, written atomically
+    :return: number of entries written
+    """
+    from heapq import merge
+
+    def entries(position, path):
+        with open(path) as f:
+            for sequence, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    item = IndexItem(json.loads(line))
+                except ValueError:
+                    # torn final write of a node killed mid append
+                    logger.warn("SHARD:SKIPPING_PARTIAL_ENTRY:{}:LINE:{}".format(path, sequence + 1))
+                    continue
+                # ties broken by shard then by position, keeping an eviction tombstone after its entry
+                yield item.get_epoch() or 0, position, sequence, item, line
+
+    paths = [path for path in paths if destination_exists(path)]
+    tmp_path = "{}.tmp".format(destination)
+    written = 0
+    destinations = set()
+    with open(tmp_path, 'w') as f:
+        for epoch, position, sequence, item, line in merge(*[entries(position, path)
+                                                             for position, path in enumerate(paths)]):
+            if not item.get_evicted():
+                if item.get_destination() in destinations:
+                    continue
+                destinations.add(item.get_destination())
+            f.write(line if line.endswith('\n') else line + '\n')
+            written += 1
+    os.rename(tmp_path, destination)
+    if paths:
+        write_watermark("{}.pruned".format(destination),
+                        min(read_watermark("{}.pruned".format(path)) for path in paths))
+    logger.info("SHARD:MERGED:{}:ENTRIES:{}:INTO:{}".format(len(paths), written, destination))
+    return written
@@ -0,0 +1,84 @@
+from s3 import S3Downloader
+from pool import DownloadPool
+from exceptions import SharedSaveDirectory, TenantTransportConflict
+from collections import OrderedDict
+import os
+import logging
+
+logger = logging.getLogger('Tenants')
+
+
+class MultiTenantDownloader(object):
+    """
+    Downloads for several tenants (each with its own auth, API and save sections) from one process. Every tenant
+    keeps its own S3Downloader, so its own index, journal and save directory, while all of them share one pool of
+    workers, one bandwidth budget (a tenant's own max_bandwidth caps it within) and one transport, so connections
+    and proxy tunnels are pooled across tenants, served in turns (see DownloadPool).
+    """
+
+    def __init__(self, configs, pool_config=None):
+        """
+        :param configs: list of tenant configs, see utils.load_tenant_configs. A tenant is named by its name key,
+        defaulting to its save directory. Their transport settings (see S3Downloader.get_transport_settings) must
+        agree
+        :param pool_config: shared pool section {'workers': 10, 'max_bandwidth': '50M', 'burst': '10M'}
+        """
+        pool_config = pool_config or {}
+        self.configs = OrderedDict()
+        self.tenants = OrderedDict()
+        directories = {}
+        for config in configs:
+            name = config.get('name') or config['save']['directory']
+            directory = os.path.realpath(config['save']['directory'])
+            if directory in directories:
+                raise SharedSaveDirectory(directory, [directories[directory], name])
+            directories[directory] = name
+            self.configs[name] = config
+        self.pool = DownloadPool(pool_config.get('workers', 10),
+                                 max_bandwidth=pool_config.get('max_bandwidth'),
+                                 burst=pool_config.get('burst'))
+        self.transport = None
+        if self.configs:
+            settings = OrderedDict((name, S3Downloader.get_transport_settings(config['save']))
+                                   for name, config in self.configs.items())
+            first = settings.values()[0]
+            conflicting = [name for name, setting in settings.items() if setting != first]
+            if conflicting:
+                raise TenantTransportConflict([settings.keys()[0]] + conflicting)
+            pool_size = max([self.pool.workers] + [config['save'].get('meta_concurrency', 32)
+                                                   for config in self.configs.values()])
+            self.transport = S3Downloader.build_transport(self.configs.values()[0]['save'], pool_size)
+        for name, config in self.configs.items():
+            self.tenants[name] = S3Downloader(config['save'], transport=self.transport)
+        logger.info("TENANTS:{}:WORKERS:{}:MAX_BANDWIDTH:{}:TRANSPORT:{}".format(
+            len(self.tenants), self.pool.workers, self.pool.max_bandwidth,
+            self.transport.name.upper() if self.transport else None))
+
+    def get_names(self):
+        return list(self.tenants)
+
+    def get_config(self, name):
+        """
+        :param name: tenant name
+        :return: the tenant's config, its auth and API sections are what its report listings are fetched with
+        """
+        return self.configs[name]
+
+    def get_downloader(self, name):
+        """
+        :param name: tenant name
+        :return: S3Downloader
+        """
+        return self.tenants[name]
+
+    def download_reports(self, reports):
+        """
+        Download the reports of every tenant on the shared pool
+        :param reports: dict {tenant name: Reports listed with that tenant's credentials}
+        :return: OrderedDict {tenant name: result as S3Downloader.download_reports}
+        """
+        names = [name for name in self.tenants if name in reports]
+        for name in names:
+            self.tenants[name].add_reports(reports[name])
+        results = self.pool.download([self.tenants[name] for name in names])
+        return OrderedDict(zip(names, results))
@@ -0,0 +1,297 @@
+from utils import make_sure_directory_exists, destination_exists
+from exceptions import UnknownTransform, TransformError
+import os
+import re
+import logging
+
+logger = logging.getLogger('Transforms')
+
+ENTRY_POINT_GROUP = 's3cli.transforms'
+
+
+class Transform(object):
+    """
+    A stage the bytes of a downloaded object are teed into as they are written, so derived outputs are produced in
+    the same pass as the download rather than by re-reading the file afterwards.
+    A new instance is created for every object, configured with the options given in config.yml:
+    transforms:
+      - name: line_filter
+        types: [station]
+        pattern: 'tenant,adrtgw45'
+    """
+    name = None
+
+    def __init__(self, url, types=None, **options):
+        """
+        :param url: URL being downloaded
+        :param types: report types the transform applies to, None for all
+        :param options: transform specific options from config.yml
+        """
+        self.url = url
+        self.types = types
+        self.options = options
+        # derived files written next to the download, indexed with it and removed along with it
+        self.outputs = []
+
+    @classmethod
+    def accepts(cls, url, types=None):
+        return not types or url.get_type() in types
+
+    @classmethod
+    def get_outputs(cls, url, **options):
+        """
+        :param url: URL
+        :param options: transform specific options from config.yml
+        :return: list of the derived file paths the transform writes for url
+        """
+        return []
+
+    def write(self, chunk):
+        """
+        :param chunk: next bytes of the object
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        The object downloaded completely
+        """
+        pass
+
+    def abort(self):
+        """
+        The download failed, discard anything produced
+        """
+        pass
+
+
+class LineTransform(Transform):
+    """
+    Transform over complete lines, reassembled across chunk boundaries
+    """
+
+    def __init__(self, url, types=None, **options):
+        super(LineTransform, self).__init__(url, types, **options)
+        self.remainder = b''
+        self.line_number = 0
+
+    def write(self, chunk):
+        lines = (self.remainder + chunk).split(b'\n')
+        self.remainder = lines.pop()
+        for line in lines:
+            self.line(line + b'\n')
+
+    def close(self):
+        if self.remainder:
+            self.line(self.remainder)
+            self.remainder = b''
+        self.finish()
+
+    def line(self, line):
+        self.line_number += 1
+        self.process(line)
+
+    def process(self, line):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+
+class LineFilter(LineTransform):
+    """
+    Write the lines matching a regular expression (and the header) to a derived file next to the download,
+    i.e station.csv -> station.filtered.csv
+    options: pattern, suffix (default 'filtered'), keep_header (default true), invert (default false)
+    """
+    name = 'line_filter'
+
+    def __init__(self, url, types=None, pattern=None, suffix='filtered', keep_header=True, invert=False, **options):
+        super(LineFilter, self).__init__(url, types, **options)
+        if not pattern:
+            raise TransformError("line_filter: a pattern is required")
+        self.pattern = re.compile(pattern)
+        self.keep_header = keep_header
+        self.invert = invert
+        self.destination = self.get_outputs(url, suffix)[0]
+        self.tmp_destination = "{}.tmp".format(self.destination)
+        make_sure_directory_exists(self.destination)
+        self.handle = open(self.tmp_destination, 'wb')
+
+    @classmethod
+    def get_outputs(cls, url, suffix='filtered', **options):
+        root, ext = os.path.splitext(url.get_path())
+        return ["{}.{}{}".format(root, suffix, ext)]
+
+    def process(self, line):
+        if (self.keep_header and self.line_number == 1) or bool(self.pattern.search(line)) != self.invert:
+            self.handle.write(line)
+
+    def finish(self):
+        self.handle.close()
+        os.rename(self.tmp_destination, self.destination)
+        self.outputs.append(self.destination)
+
+    def abort(self):
+        self.handle.close()
+        if destination_exists(self.tmp_destination):
+            os.remove(self.tmp_destination)
+
+
+class HeaderValidator(Transform):
+    """
+    Check the CSV header of the object against the expected columns
+    options: columns (list), strict (default true) fails the download on a mismatch rather than logging it
+    """
+    name = 'validate_header'
+
+    def __init__(self, url, types=None, columns=None, strict=True, **options):
+        super(HeaderValidator, self).__init__(url, types, **options)
+        self.columns = columns or []
+        self.strict = strict
+        self.header = b''
+        self.checked = False
+
+    def write(self, chunk):
+        if self.checked:
+            return
+        self.header += chunk
+        if b'\n' in self.header:
+            self.check(self.header.split(b'\n', 1)[0])
+
+    def close(self):
+        if not self.checked:
+            self.check(self.header)
+
+    def check(self, header):
+        self.checked = True
+        columns = [column.strip().strip('"') for column in header.rstrip(b'\r').split(b',')]
+        if columns == self.columns:
+            return
+        message = "HEADER_MISMATCH:{}:EXPECTED:{}:GOT:{}".format(self.url.get_path(), self.columns, columns)
+        if self.strict:
+            raise TransformError(message)
+        logger.warn(message)
+
+
+class SocketForwarder(Transform):
+    """
+    Forward the object's bytes to a TCP socket as they are downloaded
+    options: host, port, timeout (default 10)
+    """
+    name = 'forward'
+
+    def __init__(self, url, types=None, host='localhost', port=None, timeout=10, **options):
+        import socket
+
+        super(SocketForwarder, self).__init__(url, types, **options)
+        if not port:
+            raise TransformError("forward: a port is required")
+        self.sock = socket.create_connection((host, int(port)), timeout)
+
+    def write(self, chunk):
+        self.sock.sendall(chunk)
+
+    def close(self):
+        self.sock.close()
+
+    def abort(self):
+        self.sock.close()
+
+
+registry = dict((transform.name, transform) for transform in (LineFilter, HeaderValidator, SocketForwarder))
+
+
+def register(transform):
+    """
+    Register a Transform subclass under its name, usable as a class decorator
+    """
+    registry[transform.name] = transform
+    return transform
+
+
+def get_transform(name):
+    """
+    Resolve a transform by name from the built-ins, then the s3cli.transforms entry points of installed packages
+    :param name:
+    :return: Transform subclass
+    """
+    if name not in registry:
+        import pkg_resources
+
+        for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+            registry[name] = entry_point.load()
+            break
+        else:
+            raise UnknownTransform(name)
+    return registry[name]
+
+
+class Stage(object):
+    """
+    The transforms applied to one object
+    """
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def write(self, chunk):
+        for transform in self.transforms:
+            transform.write(chunk)
+
+    def close(self):
+        """
+        :return: list of the derived files written
+        """
+        for transform in self.transforms:
+            transform.close()
+        return [path for transform in self.transforms for path in transform.outputs]
+
+    def abort(self):
+        for transform in self.transforms:
+            try:
+                transform.abort()
+            except Exception as e:
+                logger.warn("TRANSFORM:ABORT_FAILED:{}:MESSAGE:{}".format(transform.name, e))
+
+
+class Pipeline(object):
+    """
+    Transforms configured for a download run, resolved once in the coordinator and inherited by the workers
+    """
+
+    def __init__(self, specs=None):
+        """
+        :param specs: transforms section of config.yml, a list of {name: ..., <options>}
+        """
+        self.transforms = []
+        for spec in specs or []:
+            options = dict(spec)
+            self.transforms.append((get_transform(options.pop('name')), options))
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def start(self, url):
+        """
+        :param url: URL about to be downloaded
+        :return: Stage or None when no transform applies to the url
+        """
+        transforms = []
+        try:
+            for transform, options in self.transforms:
+                if transform.accepts(url, options.get('types')):
+                    transforms.append(transform(url, **options))
+        except Exception:
+            Stage(transforms).abort()
+            raise
+        return Stage(transforms) if transforms else None
+
+    def get_outputs(self, url):
+        """
+        Derived files an earlier download of url left, for a local copy that is revalidated rather than downloaded
+        :param url: URL
+        :return: list of paths
+        """
+        return [path for transform, options in self.transforms if transform.accepts(url, options.get('types'))
+                for path in transform.get_outputs(url, **options) if destination_exists(path)]
@@ -0,0 +1,586 @@
+from utils import parse_size
+import os
+import time
+import logging
+
+logger = logging.getLogger('Transport')
+
+
+class TransportStats(object):
+    """
+    Request, connection and proxy tunnel counters shared between worker processes, so a run can report how often a
+    connection (or CONNECT tunnel) had to be set up and what it cost. Must be created before the worker processes are
+    started.
+    """
+
+    def __init__(self):
+        from multiprocessing import Value, Lock
+
+        self.lock = Lock()
+        self.requests = Value('l', 0, lock=False)
+        self.connections = Value('l', 0, lock=False)
+        self.dns_lookups = Value('l', 0, lock=False)
+        self.tunnels = Value('l', 0, lock=False)
+        self.tunnel_seconds = Value('d', 0.0, lock=False)
+
+    def record(self, counter):
+        """
+        :param counter: requests, connections or dns_lookups
+        """
+        with self.lock:
+            getattr(self, counter).value += 1
+
+    def record_tunnel(self, seconds):
+        """
+        :param seconds: time from opening the connection to the proxy to the end of its CONNECT handshake
+        """
+        with self.lock:
+            self.tunnels.value += 1
+            self.tunnel_seconds.value += seconds
+
+    def get_metrics(self):
+        """
+        :return: dict {'requests': n, 'connections': n, 'dns_lookups': n, 'tunnels': n, 'tunnel_seconds': s,
+        'tunnel_avg_ms': ms}
+        """
+        with self.lock:
+            metrics = {'requests': self.requests.value, 'connections': self.connections.value,
+                       'dns_lookups': self.dns_lookups.value, 'tunnels': self.tunnels.value,
+                       'tunnel_seconds': self.tunnel_seconds.value}
+        metrics['tunnel_avg_ms'] = metrics['tunnel_seconds'] * 1000 / metrics['tunnels'] if metrics['tunnels'] else 0.0
+        return metrics
+
+
+def get_socket_options(receive_buffer=None, nodelay=True):
+    """
+    :param receive_buffer: SO_RCVBUF in bytes (or 4M style size), None keeps the kernel's auto-tuned buffer
+    :param nodelay: set TCP_NODELAY
+    :return: list of setsockopt arguments
+    """
+    import socket
+
+    options = []
+    if nodelay:
+        options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+    if receive_buffer:
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, parse_size(receive_buffer)))
+    return options
+
+
+class DnsCache(object):
+    """
+    getaddrinfo results kept for ttl seconds, so connections to the same bucket endpoint don't each wait on a
+    resolver round trip. An entry is dropped when none of its addresses can be connected to.
+    """
+
+    def __init__(self, ttl=300, stats=None):
+        """
+        :param ttl: seconds an entry is reused, 0 to resolve every time
+        :param stats: TransportStats counting the lookups and connections
+        """
+        self.ttl = ttl
+        self.stats = stats
+        self.entries = {}  # (host, port) -> (expires, getaddrinfo result)
+
+    def resolve(self, host, port):
+        import socket
+
+        key = (host, port)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        if self.stats is not None:
+            self.stats.record('dns_lookups')
+        if self.ttl:
+            self.entries[key] = (time.time() + self.ttl, addresses)
+        return addresses
+
+    def create_connection(self, address, timeout=None, socket_options=None, source_address=None):
+        """
+        socket.create_connection through the cache, the socket options are set before connecting (SO_RCVBUF has to
+        be, the TCP window scale is agreed on during the handshake)
+        :param address: tuple (host, port)
+        :param timeout: seconds, None (or socket._GLOBAL_DEFAULT_TIMEOUT) for the default
+        :param socket_options: list of setsockopt arguments
+        :param source_address: tuple (host, port) to bind to
+        :return: connected socket
+        """
+        import socket
+
+        host, port = address
+        error = None
+        for family, socktype, proto, canonname, sockaddr in self.resolve(host, port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                for option in socket_options or []:
+                    sock.setsockopt(*option)
+                if timeout is not None and timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                if self.stats is not None:
+                    self.stats.record('connections')
+                return sock
+            except socket.error as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        self.entries.pop((host, port), None)
+        raise error if error is not None else socket.error("getaddrinfo returns an empty list")
+
+
+class Transport(object):
+    """
+    HTTP client shared by the downloads and the metadata probes of a downloader. Every process gets its own session
+    (a forked worker never reuses its parent's sockets), whose connections, and the CONNECT tunnels through a proxy,
+    are kept alive from one request to the next instead of set up per object.
+    Responses expose status_code, headers and, unless streamed, content; a streamed body is read with readinto and
+    every response is handed back with close.
+    """
+    name = None
+
+    def __init__(self, proxies=None, pool_size=10, stats=None, receive_buffer=None, nodelay=True, dns_ttl=300):
+        """
+        :param proxies: list of models.Proxy, direct connections when empty
+        :param pool_size: connections kept alive per host (or proxied host)
+        :param stats: TransportStats, created here when not given
+        :param receive_buffer: SO_RCVBUF, see get_socket_options
+        :param nodelay: TCP_NODELAY
+        :param dns_ttl: seconds resolved addresses are cached, see DnsCache
+        """
+        self.proxies = {}
+        for proxy in proxies or []:
+            self.proxies.update(proxy.get_proxies())
+        self.pool_size = pool_size
+        self.stats = stats if stats is not None else TransportStats()
+        self.socket_options = get_socket_options(receive_buffer, nodelay)
+        self.dns = DnsCache(dns_ttl, self.stats)
+        self.session = None
+        self.pid = None
+
+    def get_session(self):
+        if self.session is None or self.pid != os.getpid():
+            self.session = self.create_session()
+            self.pid = os.getpid()
+            if self.proxies:
+                logger.debug("TRANSPORT:{}:SESSION:PID:{}:PROXIES:{}".format(self.name.upper(), self.pid,
+                                                                            ','.join(sorted(self.proxies))))
+        return self.session
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        """
+        GET through the pooled session and the configured proxies, failures raise requests' exceptions whatever
+        the transport
+        :param url:
+        :param headers: dict
+        :param timeout: connect/read timeout in seconds
+        :param stream: leave the body to readinto, otherwise it is read into content
+        :return: response
+        """
+        self.stats.record('requests')
+        return self.request(url, headers or {}, timeout, stream)
+
+    def get_metrics(self):
+        return self.stats.get_metrics()
+
+    def create_session(self):
+        raise NotImplementedError
+
+    def request(self, url, headers, timeout, stream):
+        raise NotImplementedError
+
+    def readinto(self, response, view):
+        """
+        Read the next part of a streamed body
+        :param response:
+        :param view: memoryview (or bytearray) filled from its start
+        :return: number of bytes read, 0 at the end of the body
+        """
+        raise NotImplementedError
+
+    def close(self, response):
+        """
+        Return the connection of a response read to its end to the pool, drop the connection of one abandoned
+        mid-body
+        """
+        raise NotImplementedError
+
+
+def get_pool_classes(stats, dns):
+    """
+    urllib3 connection pools whose connections resolve through the DnsCache and time their CONNECT tunnels into a
+    TransportStats. Built on first use so requests isn't imported along with this module.
+    :return: dict scheme -> pool class
+    """
+    import socket
+    from requests.packages.urllib3.connection import HTTPConnection, VerifiedHTTPSConnection
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+    def new_conn(connection):
+        try:
+            return dns.create_connection((connection.host, connection.port), connection.timeout,
+                                         connection.socket_options, connection.source_address)
+        except socket.timeout:
+            raise ConnectTimeoutError(connection, "Connection to %s timed out. (connect timeout=%s)" %
+                                      (connection.host, connection.timeout))
+        except socket.error as e:
+            raise NewConnectionError(connection, "Failed to establish a new connection: %s" % e)
+
+    class CachedHTTPConnection(HTTPConnection):
+        _new_conn = new_conn
+
+    class CachedHTTPSConnection(VerifiedHTTPSConnection):
+        _new_conn = new_conn
+
+        def _tunnel(self):
+            ts = time.time()
+            VerifiedHTTPSConnection._tunnel(self)
+            stats.record_tunnel(time.time() - ts)
+
+    class CachedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = CachedHTTPConnection
+
+    class CachedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = CachedHTTPSConnection
+
+    return {'http': CachedHTTPConnectionPool, 'https': CachedHTTPSConnectionPool}
+
+
+class RequestsTransport(Transport):
+    """
+    Transport on a requests session, with the socket options and DNS cache applied to its urllib3 pools
+    """
+    name = 'requests'
+
+    def create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        pool_classes = get_pool_classes(self.stats, self.dns)
+        socket_options = self.socket_options
+
+        class TransportAdapter(HTTPAdapter):
+
+            def init_poolmanager(self, *args, **kwargs):
+                HTTPAdapter.init_poolmanager(self, *args, socket_options=socket_options, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = pool_classes
+
+            def proxy_manager_for(self, proxy, **proxy_kwargs):
+                new = proxy not in self.proxy_manager
+                manager = HTTPAdapter.proxy_manager_for(self, proxy, socket_options=socket_options, **proxy_kwargs)
+                if new and not proxy.lower().startswith('socks'):
+                    manager.pool_classes_by_scheme = pool_classes
+                return manager
+
+        session = requests.Session()
+        adapter = TransportAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, url, headers, timeout, stream):
+        # passed per request, the session's own proxies would be overridden by the environment's
+        return self.get_session().get(url, headers=headers, timeout=timeout, stream=stream,
+                                      proxies=self.proxies or None)
+
+    def readinto(self, response, view):
+        # the raw (undecoded) body, as Content-Length and ranged resumes count it
+        import requests
+        from requests.packages.urllib3.exceptions import ReadTimeoutError, ProtocolError, SSLError
+
+        try:
+            return response.raw.readinto(view)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e)
+        except SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    def close(self, response):
+        if response.status_code in (204, 304):
+            # no body, reading it hands the connection back rather than closing it
+            response.raw.read()
+        response.close()
+
+
+class SocketConnection(object):
+    """
+    Kept alive connection of the SocketTransport, with the bytes received past the end of the last read
+    """
+
+    def __init__(self, sock, key):
+        self.sock = sock
+        self.key = key
+        self.pending = b''
+
+    def fill(self, size=65536):
+        import socket
+        import errno
+
+        data = self.sock.recv(size)
+        if not data:
+            raise socket.error(errno.ECONNRESET, "Connection closed by the server")
+        self.pending += data
+
+    def read_until(self, marker, limit=65536):
+        """
+        :return: the bytes up to marker, which is consumed
+        """
+        while marker not in self.pending:
+            if len(self.pending) > limit:
+                raise ValueError("TRANSPORT:HEADER_TOO_LONG:{}".format(len(self.pending)))
+            self.fill()
+        line, _, self.pending = self.pending.partition(marker)
+        return line
+
+    def readinto(self, view, size):
+        if self.pending:
+            size = min(size, len(self.pending))
+            view[:size] = self.pending[:size]
+            self.pending = self.pending[size:]
+            return size
+        return self.sock.recv_into(view, size)
+
+    def close(self):
+        self.sock.close()
+
+
+class SocketResponse(object):
+    """
+    Response of the SocketTransport, bodies framed by Content-Length, chunked or ending with the connection
+    """
+
+    def __init__(self, connection, status_code, headers, reusable):
+        self.connection = connection
+        self.status_code = status_code
+        self.headers = headers
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self.chunk_left = 0
+        length = headers.get('Content-Length')
+        if status_code in (204, 304) or status_code < 200:
+            self.remaining = 0
+        elif self.chunked or length is None:
+            self.remaining = None
+        else:
+            self.remaining = int(length)
+        self.reusable = reusable and (self.remaining is not None or self.chunked)
+        self.done = self.remaining == 0
+        self.content = None
+
+    def readinto(self, view):
+        if self.done:
+            return 0
+        if self.chunked:
+            if not self.chunk_left:
+                self.chunk_left = int(self.connection.read_until(b'\r\n').split(b';')[0], 16)
+                if not self.chunk_left:
+                    # optional trailers, then an empty line
+                    while self.connection.read_until(b'\r\n'):
+                        pass
+                    self.done = True
+                    return 0
+            size = min(len(view), self.chunk_left)
+        else:
+            size = len(view) if self.remaining is None else min(len(view), self.remaining)
+        read = self.connection.readinto(view, size)
+        if not read:
+            # closed by the server, a body cut short is caught by the caller's size check
+            self.done = True
+            self.reusable = False
+            return 0
+        if self.chunked:
+            self.chunk_left -= read
+            if not self.chunk_left:
+                self.connection.read_until(b'\r\n')
+        elif self.remaining is not None:
+            self.remaining -= read
+            self.done = not self.remaining
+        return read
+
+    def read(self):
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        parts = []
+        for read in iter(lambda: self.readinto(view), 0):
+            parts.append(view[:read].tobytes())
+        return b''.join(parts)
+
+
+class SocketTransport(Transport):
+    """
+    Thin HTTP/1.1 client on raw sockets: a GET is one sendall and the body is received straight into the caller's
+    buffer with recv_into, with none of the per chunk work of requests/urllib3 (generators, intermediate strings,
+    decoding). Redirects aren't followed, pre-signed object urls aren't redirected. TLS is verified against the CA
+    bundle requests uses (REQUESTS_CA_BUNDLE when set).
+    """
+    name = 'socket'
+
+    def __init__(self, *args, **kwargs):
+        Transport.__init__(self, *args, **kwargs)
+        self.ssl_context = None
+
+    def create_session(self):
+        return {}  # (scheme, host, port) -> list of idle SocketConnection
+
+    def get_ssl_context(self):
+        if self.ssl_context is None:
+            import ssl
+            from requests import certs
+
+            self.ssl_context = ssl.create_default_context(cafile=os.environ.get('REQUESTS_CA_BUNDLE') or
+                                                          certs.where())
+        return self.ssl_context
+
+    @staticmethod
+    def get_proxy_headers(proxy):
+        """
+        :param proxy: parsed proxy url
+        :return: list of header lines
+        """
+        import base64
+        from urllib import unquote
+
+        if not proxy.username:
+            return []
+        credentials = "{}:{}".format(unquote(proxy.username), unquote(proxy.password or ''))
+        return ["Proxy-Authorization: Basic {}".format(base64.b64encode(credentials))]
+
+    def connect(self, key, timeout):
+        from urlparse import urlparse
+        import requests
+
+        scheme, host, port = key
+        proxy = urlparse(self.proxies[scheme]) if scheme in self.proxies else None
+        if proxy is None:
+            sock = self.dns.create_connection((host, port), timeout, self.socket_options)
+        else:
+            sock = self.dns.create_connection((proxy.hostname, proxy.port or 80), timeout, self.socket_options)
+        connection = SocketConnection(sock, key)
+        if proxy is not None and scheme == 'https':
+            ts = time.time()
+            target = "{}:{}".format(host, port)
+            lines = ["CONNECT {} HTTP/1.1".format(target), "Host: {}".format(target)] + self.get_proxy_headers(proxy)
+            sock.sendall("\r\n".join(lines) + "\r\n\r\n")
+            status_line = connection.read_until(b'\r\n\r\n').split(b'\r\n', 1)[0]
+            if status_line.split(None, 2)[1:2] != [b'200']:
+                sock.close()
+                raise requests.exceptions.ProxyError("TUNNEL_FAILED: {}".format(status_line))
+            self.stats.record_tunnel(time.time() - ts)
+        if scheme == 'https':
+            connection.sock = self.get_ssl_context().wrap_socket(sock, server_hostname=host)
+        return connection
+
+    def request(self, url, headers, timeout, stream):
+        from urlparse import urlparse
+        from requests.structures import CaseInsensitiveDict
+        import requests
+        import socket
+
+        parts = urlparse(url)
+        default_port = 443 if parts.scheme == 'https' else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+        if parts.scheme == 'http' and 'http' in self.proxies:
+            target = url
+            extra = self.get_proxy_headers(urlparse(self.proxies['http']))
+        else:
+            target = "{}?{}".format(parts.path or '/', parts.query) if parts.query else parts.path or '/'
+            extra = []
+        lines = ["GET {} HTTP/1.1".format(target),
+                 "Host: {}".format(parts.netloc.rpartition('@')[2]),
+                 "Accept-Encoding: identity",
+                 "Connection: keep-alive"]
+        lines += ["{}: {}".format(name, value) for name, value in headers.items()] + extra
+        message = "\r\n".join(lines) + "\r\n\r\n"
+
+        idle = self.get_session().setdefault(key, [])
+        while True:
+            connection = idle.pop() if idle else None
+            reused = connection is not None
+            try:
+                if connection is None:
+                    connection = self.connect(key, timeout)
+                connection.sock.settimeout(timeout)
+                connection.sock.sendall(message)
+                head = connection.read_until(b'\r\n\r\n')
+                break
+            except (socket.error, ValueError) as e:
+                if connection is not None:
+                    connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # closed by the server while idle, the request is tried again on a new connection
+                    continue
+                raise self.translate(e, connected=connection is not None)
+        status_line, _, header_lines = head.partition(b'\r\n')
+        version, status = status_line.split(None, 2)[:2]
+        response_headers = CaseInsensitiveDict()
+        for line in header_lines.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            name, value = name.strip(), value.strip()
+            response_headers[name] = "{}, {}".format(response_headers[name], value) \
+                if name in response_headers else value
+        connection_header = response_headers.get('Connection', '').lower()
+        reusable = connection_header == 'keep-alive' if version == 'HTTP/1.0' else connection_header != 'close'
+        response = SocketResponse(connection, int(status), response_headers, reusable)
+        if not stream:
+            try:
+                response.content = response.read()
+            except (socket.error, ValueError) as e:
+                connection.close()
+                raise self.translate(e)
+            self.close(response)
+        return response
+
+    @staticmethod
+    def translate(error, connected=True):
+        """
+        :return: the requests exception matching a socket/ssl error
+        """
+        import requests
+        import socket
+        import ssl
+
+        if isinstance(error, socket.timeout) or (isinstance(error, ssl.SSLError) and 'timed out' in str(error)):
+            return (requests.exceptions.ReadTimeout if connected else requests.exceptions.ConnectTimeout)(error)
+        if isinstance(error, (ssl.SSLError, ssl.CertificateError)):
+            return requests.exceptions.SSLError(error)
+        if isinstance(error, ValueError):
+            return requests.exceptions.ChunkedEncodingError(error)
+        return requests.exceptions.ConnectionError(error)
+
+    def readinto(self, response, view):
+        import socket
+
+        try:
+            return response.readinto(view)
+        except (socket.error, ValueError) as e:
+            raise self.translate(e)
+
+    def close(self, response):
+        connection = response.connection
+        if connection is None:
+            return
+        response.connection = None
+        idle = self.get_session().setdefault(connection.key, [])
+        if response.done and response.reusable and len(idle) < self.pool_size:
+            idle.append(connection)
+        else:
+            connection.close()
+
+
+TRANSPORTS = {RequestsTransport.name: RequestsTransport, SocketTransport.name: SocketTransport}
+
+
+def create_transport(name='requests', *args, **kwargs):
+    """
+    :param name: requests or socket
+    :param args: see Transport
+    :return: Transport
+    """
+    if name not in TRANSPORTS:
+        raise Exception("INVALID_TRANSPORT: {}, must be one of {}".format(name, ', '.join(sorted(TRANSPORTS))))
+    return TRANSPORTS[name](*args, **kwargs)
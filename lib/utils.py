@@ -1,30 +1,77 @@
 from __future__ import print_function
-import yaml
-import json
-import requests
 import os
 import errno
 import logging
-from logging.handlers import RotatingFileHandler
 import sys
 import re
+import time
+from collections import namedtuple
 # from .models import Reports, Report, IndexItem, URL, Service
 from datetime import timedelta, datetime
 from .exceptions import *
-import imp
-
-try:
-    imp.find_module('tqdm')
-    import tqdm
 
-    loading_bar = True
-except ImportError:
-    loading_bar = False
+# heavy/optional dependencies (yaml, requests, tqdm, logging.handlers, signal) are imported lazily within the
+# functions that need them, keeping start-up cheap for listing-only and "nothing new" runs
+_tqdm = None
 
 logger = logging.getLogger('Util')
 
-import signal
-import time
+# fixed-size record workers send back to the coordinating process in place of the (large) URL objects they worked on
+TaskResult = namedtuple('TaskResult', ['task_id', 'status', 'size', 'duration', 'etag', 'digest', 'rows', 'header',
+                                       'error', 'derived'])
+TaskResult.__new__.__defaults__ = (None, None, None, None)
+TASK_OK = 0
+TASK_FAILED = 1
+TASK_NO_SPACE = 2
+# classes of TASK_FAILED, each with its own retry budget (see lib/retry.py)
+ERROR_TIMEOUT = 'timeout'
+ERROR_SERVER = 'server'  # 5xx, throttling and dropped connections
+ERROR_EXPIRED = 'expired'  # 403, the pre-signed url has expired and must be re-signed
+ERROR_IO = 'io'  # local disk errors
+ERROR_REJECTED = 'rejected'  # other 4xx and transform rejections, retrying won't help
+ERROR_INTERRUPTED = 'interrupted'
+ERROR_UNKNOWN = 'unknown'
+
+
+def classify_status(status_code):
+    """
+    Error class of an unsuccessful HTTP status
+    :param status_code: int
+    :return: ERROR_* constant
+    """
+    if status_code == 403:
+        return ERROR_EXPIRED
+    if status_code >= 500 or status_code == 429:
+        return ERROR_SERVER
+    return ERROR_REJECTED
+
+
+def get_tqdm():
+    """
+    Lazily import the optional tqdm package
+    :return: tqdm module or None when not installed
+    """
+    global _tqdm
+    if _tqdm is None:
+        try:
+            import tqdm
+            _tqdm = tqdm
+        except ImportError:
+            _tqdm = False
+    return _tqdm or None
+
+
+def progress_write(message):
+    """
+    Write a message without clobbering any active progress bars
+    :param message:
+    :return:
+    """
+    tqdm = get_tqdm()
+    if tqdm:
+        tqdm.tqdm.write(message)
+    else:
+        print(message)
 
 
 class catch_sigint(object):
@@ -35,16 +82,42 @@ class catch_sigint(object):
         self.caught_sigint = True
 
     def __enter__(self):
+        import signal
         self.oldsigint = signal.signal(signal.SIGINT, self.note_sigint)
         return self
 
     def __exit__(self, *args):
+        import signal
         signal.signal(signal.SIGINT, self.oldsigint)
 
     def __call__(self):
         return self.caught_sigint
 
 
+class sigterm_as_interrupt(object):
+    """
+    Raise KeyboardInterrupt on SIGTERM (i.e a service stop or restart) so the same cleanup runs as for Ctrl-C
+    """
+
+    def raise_interrupt(self, signum, frame):
+        raise KeyboardInterrupt("SIGTERM")
+
+    def install(self):
+        import signal
+        self.oldsigterm = signal.signal(signal.SIGTERM, self.raise_interrupt)
+        return self
+
+    def restore(self):
+        import signal
+        signal.signal(signal.SIGTERM, self.oldsigterm)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *args):
+        self.restore()
+
+
 def truncate_dict(d):
     top = d.items()[0:1]
     bottom = d.items()[-2:]
@@ -108,7 +181,7 @@ class TqdmLoggingHandler(logging.Handler):
     def emit(self, record):
         try:
             msg = self.format(record)
-            tqdm.tqdm.write(msg)
+            progress_write(msg)
             self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
@@ -116,7 +189,14 @@ class TqdmLoggingHandler(logging.Handler):
             self.handleError(record)
 
 
-logger.addHandler(TqdmLoggingHandler())
+def install_progress_logging():
+    """
+    Route Util logging through tqdm so log lines don't break progress bars. Deferred until a download actually
+    starts, idempotent.
+    :return:
+    """
+    if not any(isinstance(handler, TqdmLoggingHandler) for handler in logger.handlers):
+        logger.addHandler(TqdmLoggingHandler())
 
 
 @logthis(logger, logging.DEBUG)
@@ -127,6 +207,8 @@ def load_config(file_path):
     :return: dict
     """
 
+    import yaml
+
     with open(file_path, 'r') as fp:
         try:
             config = yaml.load(fp)
@@ -136,6 +218,33 @@ def load_config(file_path):
             return None
 
 
+@logthis(logger, logging.DEBUG)
+def load_tenant_configs(file_path):
+    """
+    Load the tenant configs of a config.yml serving several tenants from one process. Its tenants list holds paths
+    (relative to the config.yml) of per tenant config files and/or inline configs, the top level auth, API and save
+    sections are defaults each tenant's own sections are merged over. A config.yml without tenants is one tenant.
+    :param file_path:
+    :return: tuple (list of config dicts, pool section dict)
+    """
+    config = load_config(file_path)
+    tenants = config.get('tenants')
+    if not tenants:
+        return [config], config.get('pool') or {}
+    configs = []
+    for tenant in tenants:
+        if isinstance(tenant, basestring):
+            tenant_path = os.path.join(os.path.dirname(os.path.abspath(file_path)), tenant)
+            tenant = load_config(tenant_path)
+            tenant.setdefault('name', os.path.splitext(os.path.basename(tenant_path))[0])
+        merged = dict(tenant)
+        for section in ('auth', 'API', 'save'):
+            merged[section] = dict(config.get(section) or {})
+            merged[section].update(tenant.get(section) or {})
+        configs.append(merged)
+    return configs, config.get('pool') or {}
+
+
 @logthis(logger, logging.DEBUG)
 def process_token(response):
     """
@@ -295,6 +404,8 @@ def setup_logging(logging_conf):
         log.addHandler(ch)
 
     if logging_conf['enabled'] and logging_conf['file']:
+        from logging.handlers import RotatingFileHandler
+
         make_sure_directory_exists(logging_conf['file'])
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                                       datefmt='%m/%d/%Y %I:%M:%S %p', )
@@ -310,14 +421,98 @@ def setup_logging(logging_conf):
     return
 
 
-def multi_download_file(write_lock, idx, num_tasks, url, attempt, chunk_size, timeout):
-    return download_file(url, attempt, write_lock, chunk_size, timeout, idx, num_tasks)
+def multi_download_file(write_lock, idx, num_tasks, url, attempt, chunk_size, timeout, task_id=None, budget=None,
+                        transforms=None, throttle=None, transport=None):
+    return download_file(url, attempt, write_lock, chunk_size, timeout, idx, num_tasks, task_id, budget, transforms,
+                         throttle, transport)
+
+
+def get_etag(response):
+    etag = response.headers.get('ETag')
+    return etag.strip('"') if etag else None
+
+
+def file_md5(path, chunk_size=65536):
+    import hashlib
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_part_path(destination):
+    """
+    Path an object is downloaded to before being moved to its destination
+    """
+    return "{}.part".format(destination)
+
+
+def get_csv_stats(path, newlines):
+    """
+    Row count and header of a just written CSV, from the newlines counted while writing it
+    :param path:
+    :param newlines: number of newline characters in the file
+    :return: tuple (rows excluding the header, header line or None)
+    """
+    with open(path, 'rb') as f:
+        header = f.readline(4096)
+        if not header:
+            return 0, None
+        f.seek(-1, os.SEEK_END)
+        lines = newlines if f.read(1) == b'\n' else newlines + 1
+    return lines - 1, header.rstrip(b'\r\n')
+
+
+def read_csv_stats(path, chunk_size=65536):
+    """
+    Row count and header of a CSV already on disk, i.e a local copy revalidated rather than downloaded again
+    :param path:
+    :param chunk_size:
+    :return: tuple (rows excluding the header, header line or None)
+    """
+    newlines = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            newlines += chunk.count(b'\n')
+    return get_csv_stats(path, newlines)
+
+
+def get_file_sizes(paths):
+    """
+    :param paths: list of file paths
+    :return: list of [path, size], None when there are none
+    """
+    return [[path, os.path.getsize(path)] for path in paths] or None
+
+
+def get_conditional_headers(url_obj, destination):
+    """
+    Validators for an existing local copy of an object, so an unchanged object is answered with a 304 rather than
+    its body. S3 ETags of single part uploads are the md5 of the content, multipart ETags aren't and fall back to the
+    local modification time when the local size matches the object's (known) size.
+    :param url_obj: URL
+    :param destination: existing local copy
+    :return: tuple (headers dict, md5 of the local copy or None)
+    """
+    from email.utils import formatdate
+
+    etag = url_obj.get_etag()
+    if etag and '-' in etag:
+        if url_obj.get_size() == os.path.getsize(destination):
+            return {'If-Modified-Since': formatdate(os.path.getmtime(destination), usegmt=True)}, None
+        return {}, None
+    digest = file_md5(destination)
+    return {'If-None-Match': '"{}"'.format(digest)}, digest
 
 
 @logthis(logger, logging.DEBUG)
-def download_file(url_obj, attempt, write_lock, chunk_size=8096, timeout=20, idx=0, num_tasks=1):
+def download_file(url_obj, attempt, write_lock, chunk_size=8096, timeout=20, idx=0, num_tasks=1, task_id=None,
+                  budget=None, transforms=None, throttle=None, transport=None):
     """
-    Download a given file via requests streaming interface
+    Download a given file via requests streaming interface. The body is written to <destination>.part and renamed
+    into place once complete, an existing .part left by an interrupted run is resumed with a ranged request.
     :param url_obj:
     :param chunk_size:
     :param timeout:
@@ -326,34 +521,109 @@ def download_file(url_obj, attempt, write_lock, chunk_size=8096, timeout=20, idx
     :param write_lock:
     :param idx: process id
     :param url: s3 pre-signed object URL
-    :return:
+    :param task_id: id the coordinating process knows this url by
+    :param budget: DiskBudget to reserve the object's size against before writing it
+    :param transforms: transforms.Pipeline the downloaded chunks are teed into
+    :param throttle: pool.TokenBucket every chunk read is paced by
+    :param transport: transport.Transport keeping connections (and proxy tunnels) alive between objects, a one-off
+    requests transport when not given
+    :return: TaskResult
     """
     # TODO: Add more URL object manipulation and create an interface that enables index writing based of the state of
     #  URL object. This will give a cleaner interface for writing indexes. Potentially something like URL().index
+    import requests
+    import hashlib
+
+    if transport is None:
+        from .transport import RequestsTransport
+
+        transport = RequestsTransport(pool_size=1)
     ts = time.time()
+    reserved = 0
+    stage = None
+
+    def result(status, size=None, etag=None, digest=None, rows=None, header=None, error=None, derived=None):
+        return TaskResult(task_id, status, size, time.time() - ts, etag, digest, rows, header, error, derived)
+
     url = url_obj.get_url()
     destination = url_obj.get_path()
-    if destination_exists(destination) and attempt <= 1:
-        logger.warn("DOWNLOAD_FILE:EXISTS_ALREADY:OVERWRITING:{}".format(destination))
+    part_destination = get_part_path(destination)
+    headers = {}
+    local_digest = None
+    offset = 0
+    response = None
     if not directory_exists(destination):
         make_sure_directory_exists(destination)
     try:
-        response = requests.get(url, stream=True, timeout=timeout)
-        size = int(response.headers['Content-length'])  # size in bytes
-        url_obj.set_size(size)
+        if destination_exists(part_destination):
+            offset = os.path.getsize(part_destination)
+            if offset:
+                headers['Range'] = 'bytes={}-'.format(offset)
+                if url_obj.get_etag():
+                    # only resume when the object is still the one the partial download started on
+                    headers['If-Range'] = '"{}"'.format(url_obj.get_etag())
+        elif destination_exists(destination):
+            headers, local_digest = get_conditional_headers(url_obj, destination)
+            if local_digest is not None and local_digest == url_obj.get_etag():
+                logger.debug("DOWNLOAD_FILE:EXISTS_ALREADY:UNCHANGED:{}".format(destination))
+                rows, header = read_csv_stats(destination)
+                return result(TASK_OK, os.path.getsize(destination), local_digest, local_digest, rows, header,
+                              derived=get_file_sizes(transforms.get_outputs(url_obj) if transforms else []))
+            logger.debug("DOWNLOAD_FILE:EXISTS_ALREADY:REVALIDATING:{}".format(destination))
+        response = transport.get(url, stream=True, timeout=timeout, headers=headers)
+        if response.status_code == 304:
+            logger.debug("DOWNLOAD_FILE:NOT_MODIFIED:{}".format(destination))
+            # the index entry is rebuilt from the local copy, row count and header included
+            rows, header = read_csv_stats(destination)
+            return result(TASK_OK, os.path.getsize(destination), get_etag(response) or local_digest, local_digest,
+                          rows, header, derived=get_file_sizes(transforms.get_outputs(url_obj) if transforms else []))
+        if response.status_code == 416:
+            # the partial download is complete or longer than the object, start over
+            os.remove(part_destination)
+            return result(TASK_FAILED, error=ERROR_SERVER)
+        if response.status_code != 206:
+            offset = 0
+        if response.status_code >= 400:
+            logger.debug("DOWNLOAD_FILE:STATUS:{}:{}".format(response.status_code, destination))
+            return result(TASK_FAILED, error=classify_status(response.status_code))
+        remaining = int(response.headers['Content-length'])  # size in bytes
+        size = offset + remaining
+        if budget is not None:
+            if not budget.reserve(remaining):
+                logger.warn("DOWNLOAD_FILE:NO_SPACE:DEFERRING:{}:SIZE:{}".format(destination, size))
+                return result(TASK_NO_SPACE, size)
+            reserved = remaining
 
         logger.debug("DOWNLOAD_FILE:URL:{}..{}".format(url[:25], url[-25:]))
         logger.debug("DOWNLOAD_FILE:FILE_SIZE::{} [MB]".format(size / 10 ** 6))
 
         # return
+        md5 = hashlib.md5()
+        newlines = 0
+        if transforms:
+            stage = transforms.start(url_obj)
+        if offset:
+            logger.debug("DOWNLOAD_FILE:RESUMING:{}:AT:{}".format(destination, offset))
+            # the digest, row count and transforms cover the whole object, catch up on the bytes already on disk
+            with open(part_destination, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    md5.update(chunk)
+                    newlines += chunk.count(b'\n')
+                    if stage:
+                        stage.write(chunk)
+        # the body is received into one reused buffer rather than a new string per chunk
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        tqdm = get_tqdm()
         write_lock.acquire()
-        with open(destination, 'wb') as f:
-            if loading_bar:
+        with open(part_destination, 'ab' if offset else 'wb') as f:
+            if tqdm:
 
                 descr = "|worker:{:2}|task:{:2}/{:2}|size:{:5}[MB]|{:50}".format(
                     idx, url_obj.get_position(), num_tasks, size / 10 ** 6, destination)
 
-                with tqdm.tqdm(total=size, position=idx + 1, desc=descr, unit='B', unit_scale=True) as t:
+                with tqdm.tqdm(total=size, initial=offset, position=idx + 1, desc=descr, unit='B',
+                               unit_scale=True) as t:
                     write_lock.release()
 
                     def update():
@@ -368,98 +638,138 @@ def download_file(url_obj, attempt, write_lock, chunk_size=8096, timeout=20, idx
                         t.close()
                         write_lock.release()
 
-                    for chunk in response.iter_content(chunk_size=chunk_size):
-                        if chunk:
-                            f.write(chunk)
-                            update()
+                    for read in iter(lambda: transport.readinto(response, view), 0):
+                        chunk = view[:read]
+                        f.write(chunk)
+                        md5.update(chunk)
+                        newlines += buf.count(b'\n', 0, read)
+                        if stage:
+                            stage.write(chunk.tobytes())
+                        if throttle:
+                            throttle.consume(read)
+                        if reserved:
+                            # written bytes come off the free space itself, stop holding them twice
+                            budget.release(min(read, reserved))
+                            reserved = max(reserved - read, 0)
+                        update()
                     close()
             else:
                 write_lock.release()
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
-                        f.write(chunk)
-
+                for read in iter(lambda: transport.readinto(response, view), 0):
+                    chunk = view[:read]
+                    f.write(chunk)
+                    md5.update(chunk)
+                    newlines += buf.count(b'\n', 0, read)
+                    if stage:
+                        stage.write(chunk.tobytes())
+                    if throttle:
+                        throttle.consume(read)
+                    if reserved:
+                        # written bytes come off the free space itself, stop holding them twice
+                        budget.release(min(read, reserved))
+                        reserved = max(reserved - read, 0)
+
+        if os.path.getsize(part_destination) != size:
+            logger.warn("DOWNLOAD_FILE:TRUNCATED:{}:EXPECTED:{}".format(destination, size))
+            return result(TASK_FAILED, error=ERROR_SERVER)
+        derived = []
+        if stage:
+            derived = stage.close()
+            stage = None
+        os.rename(part_destination, destination)
         logger.debug("DOWNLOAD_FILE:COMPLETE:DESTINATION:{}".format(destination))
-        return url_obj
-    except requests.ConnectionError as ete:
-        logger.debug("DOWNLOAD_FILE:CONNECTION_TIMEOUT:MESSAGE:{}".format(ete))
-        return False
-    except requests.ReadTimeout as rte:
-        logger.debug("DOWNLOAD_FILE:READ_TIMEOUT:MESSAGE:{}".format(rte))
-        return False
+        rows, header = get_csv_stats(destination, newlines)
+        return result(TASK_OK, size, get_etag(response), md5.hexdigest(), rows, header,
+                      derived=get_file_sizes(derived))
+    except requests.Timeout as rte:
+        logger.debug("DOWNLOAD_FILE:TIMEOUT:MESSAGE:{}".format(rte))
+        return result(TASK_FAILED, error=ERROR_TIMEOUT)
+    except requests.RequestException as ete:
+        logger.debug("DOWNLOAD_FILE:CONNECTION_ERROR:MESSAGE:{}".format(ete))
+        return result(TASK_FAILED, error=ERROR_SERVER)
+    except TransformError as tre:
+        logger.error("DOWNLOAD_FILE:TRANSFORM_FAILED:{}:MESSAGE:{}".format(destination, tre))
+        # resuming would only be rejected again
+        if destination_exists(part_destination):
+            os.remove(part_destination)
+        return result(TASK_FAILED, error=ERROR_REJECTED)
+    except (IOError, OSError) as ioe:
+        logger.warn("DOWNLOAD_FILE:IO_ERROR:{}:MESSAGE:{}".format(destination, ioe))
+        return result(TASK_FAILED, error=ERROR_IO)
     except KeyboardInterrupt as kie:
         logger.debug("DOWNLOAD_FILE:KEYBOARD_INTERRUPT:MESSAGE:{}".format(kie))
-        return False
+        return result(TASK_FAILED, error=ERROR_INTERRUPTED)
     except Exception as e:
         logger.debug("DOWNLOAD_FILE:UNKNOWN_FAILURE:MESSAGE:{}".format(e))
-        return False
+        return result(TASK_FAILED, error=ERROR_UNKNOWN)
     finally:
+        if response is not None:
+            # hands a fully read connection back to the transport's pool, drops one abandoned mid-body
+            transport.close(response)
+        if stage:
+            stage.abort()
+        if reserved:
+            budget.release(reserved)
         te = time.time()
         logger.debug("DOWNLOAD_FILE:TOOK:{:0.2f} seconds".format(float((te - ts))))
 
 
-def multi_content_fetch(lk, idx, num_tasks, url, attempt, timeout):
-    return download_file_meta(lk, idx, url, num_tasks, attempt, timeout)
-
-
-def download_file_meta(lk, idx, url, num_tasks, attempt, timeout):
+def reflink(source, destination):
     """
-    Download header content from file and process into a meta object representing information about the
-    content to be downloaded.
-    :param idx:
-    :param url:
-    :param num_tasks:
-    :param attempt:
-    :param timeout:
-    :return:
+    Copy-on-write clone of source to destination (btrfs/xfs FICLONE ioctl)
+    :return: True on success
     """
-    ts = time.time()
+    import fcntl
+
+    ficlone = 0x40049409
     try:
-        response = requests.get(url.get_url(), stream=True, timeout=timeout)
-        response.close()
-        # logger.debug("DOWNLOAD_FILE_META:headers:{}".format(response.headers))
-        size = int(response.headers['Content-length'])  # size in bytes
-        url.set_size(size)
-        return url
-    except requests.ConnectionError as ete:
-        logger.debug("DOWNLOAD_FILE:CONNECTION_TIMEOUT:MESSAGE:{}".format(ete))
-        return False
-    except requests.ReadTimeout as rte:
-        logger.debug("DOWNLOAD_FILE:READ_TIMEOUT:MESSAGE:{}".format(rte))
-        return False
-    except KeyboardInterrupt as kie:
-        logger.debug("DOWNLOAD_FILE:KEYBOARD_INTERRUPT:MESSAGE:{}".format(kie))
-        return False
-    except Exception as e:
-        logger.debug("DOWNLOAD_FILE:UNKNOWN_FAILURE:MESSAGE:{}".format(e))
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+        return True
+    except (IOError, OSError) as e:
+        logger.debug("REFLINK:UNSUPPORTED:{}:MESSAGE:{}".format(destination, e))
+        if destination_exists(destination):
+            os.remove(destination)
         return False
-    finally:
-        te = time.time()
-        logger.debug("DOWNLOAD_FILE:TOOK:{:0.2f} seconds".format(float((te - ts))))
 
 
-@logthis(logger, logging.DEBUG)
-def append_index(index_path, indexItem):
+def link_file(source, destination):
     """
-    Add IndexItem to index file, if index file doesnt exist then it is created wit a+ mode
-    :param index_path:
+    Make destination share the data of source, with a hardlink or where that isn't possible (i.e across devices) a
+    reflink. An existing destination is replaced atomically.
+    :param source: existing file
     :param destination:
-    :return:
+    :return: True when linked, False when neither link type is possible
     """
-    if not make_sure_directory_exists(index_path):
-        logger.exception("APPEND_INDEX_FAILURE:CANNOT_MAKE_DIRECTORY")
-        raise Exception("CANNOT_APPEND_INDEX")
+    make_sure_directory_exists(destination)
+    tmp_destination = "{}.link".format(destination)
     try:
-        mode = 'a' if destination_exists(index_path) else 'a+'
-        with open(index_path, mode=mode) as f:
-            json.dump(indexItem.dumps(), f)
-            f.write('\n')
-        return indexItem
-    except Exception as e:
-        logger.exception("APPEND_INDEX_FAILURE:MESSAGE:{}".format(e))
-        raise Exception("CANNOT_APPEND_INDEX")
+        if destination_exists(tmp_destination):
+            os.remove(tmp_destination)
+        try:
+            os.link(source, tmp_destination)
+        except OSError as e:
+            logger.debug("LINK_FILE:HARDLINK_FAILED:{}:MESSAGE:{}".format(destination, e))
+            if not reflink(source, tmp_destination):
+                return False
+        os.rename(tmp_destination, destination)
+        logger.debug("LINK_FILE:LINKED:{}:TO:{}".format(destination, source))
+        return True
+    except OSError as e:
+        logger.warn("LINK_FILE:FAILED:{}:MESSAGE:{}".format(destination, e))
+        if destination_exists(tmp_destination):
+            os.remove(tmp_destination)
+        return False
 
 
+def get_free_space(path):
+    """
+    Bytes available to unprivileged users on the filesystem holding path
+    :param path:
+    :return: int
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
 
 
 def get_file_modified_time(destination):
@@ -498,6 +808,86 @@ def rm_file(fname):
         logger.debug("RM_FILE:REMOVED:{}".format(fname))
 
 
+def remove_empty_directories(path, root):
+    """
+    Remove the parent directories of path (i.e YYYY/MM/DD/HH) deepest first for as long as they are empty, never
+    removing root itself
+    :param path: removed file path
+    :param root: directory to stop at
+    :return: number of directories removed
+    """
+    root = os.path.abspath(root)
+    directory = os.path.dirname(os.path.abspath(path))
+    removed = 0
+    while directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # not empty (or already gone/raced with another removal), parents won't be empty either
+            break
+        removed += 1
+        directory = os.path.dirname(directory)
+    return removed
+
+
+def rm_files(fnames, root=None, workers=8):
+    """
+    Remove files in parallel and clean up any directory levels left empty below root
+    :param fnames: full file paths
+    :param root: save directory, emptied directories are only removed when given
+    :param workers: number of threads issuing deletes
+    :return: list of removed file paths
+    """
+    fnames = list(fnames)
+    if not fnames:
+        return []
+
+    def remove(fname):
+        try:
+            os.remove(fname)
+            logger.debug("RM_FILES:REMOVED:{}".format(fname))
+            return fname
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                logger.debug("FILE_ALREADY_REMOVED:{}".format(fname))
+            else:
+                logger.warn("RM_FILES:FAILED:{}:MESSAGE:{}".format(fname, e))
+            return None
+
+    if len(fnames) == 1 or workers <= 1:
+        removed = filter(None, map(remove, fnames))
+    else:
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(min(workers, len(fnames)))
+        try:
+            removed = filter(None, pool.map(remove, fnames))
+        finally:
+            pool.close()
+            pool.join()
+    if root:
+        # deepest paths first so a directory is only attempted once its children have gone
+        for fname in sorted(fnames, key=lambda x: x.count(os.sep), reverse=True):
+            remove_empty_directories(fname, root)
+    return removed
+
+
+def parse_size(size):
+    """
+    process/convert a size value such as 500M, 20G or 1T (decimal units) into bytes
+    :param size: int or str
+    :return: int
+    """
+    if size is None or isinstance(size, (int, long)):
+        return size
+    size_formatting = re.search('^(?P<value>[0-9.]+)\s*(?P<unit>[KMGT]?)B?$', str(size).strip(), re.IGNORECASE)
+    if not size_formatting:
+        raise ValueError("invalid size specified: {}, must be bytes or <value><K|M|G|T> i.e 500M or 20G".format(size))
+    multiplier = {'': 1, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}[
+        size_formatting.group('unit').upper()]
+    return int(float(size_formatting.group('value')) * multiplier)
+
+
 def get_time_now():
     return datetime.utcnow().isoformat()[:-7] + 'Z'
 
@@ -577,28 +967,29 @@ def parse_date(date):
     :param date:
     :return:
     """
+    # the report list endpoint's own format first, the formats are exclusive so the order only costs time
     try:
-        return datetime.strptime(date, 'YYYY-MM-dd').isoformat() + 'Z'
+        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ').isoformat() + 'Z'
     except Exception as e:
         # logger.exception("ERROR_PARSING:E:{}".format(e))
         pass
     try:
-        return datetime.strptime(date, '%Y-%m-%d').isoformat() + 'Z'
+        return datetime.strptime(date, 'YYYY-MM-dd').isoformat() + 'Z'
     except Exception as e:
         # logger.exception("ERROR_PARSING:E:{}".format(e))
         pass
     try:
-        return datetime.strptime(date, '%Y-%m-%d %H:%M:%S').isoformat() + 'Z'
+        return datetime.strptime(date, '%Y-%m-%d').isoformat() + 'Z'
     except Exception as e:
         # logger.exception("ERROR_PARSING:E:{}".format(e))
         pass
     try:
-        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%fZ').isoformat() + 'Z'
+        return datetime.strptime(date, '%Y-%m-%d %H:%M:%S').isoformat() + 'Z'
     except Exception as e:
         # logger.exception("ERROR_PARSING:E:{}".format(e))
         pass
     try:
-        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ').isoformat() + 'Z'
+        return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%fZ').isoformat() + 'Z'
     except Exception as e:
         # logger.exception("ERROR_PARSING:E:{}".format(e))
         pass
@@ -637,4 +1028,5 @@ def get_report_period(date):
 
 def initializer():
     """Ignore SIGINT in child workers."""
+    import signal
     signal.signal(signal.SIGINT, signal.SIG_IGN)